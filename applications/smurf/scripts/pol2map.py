@@ -425,6 +425,16 @@
 *        the coadd). The factor found in this way is stored in the FITS
 *        extension of the map made  from the observation (header "CHUNKFAC").
 *        [FALSE]
+*     NPROCS = _INTEGER (Read)
+*        The maximum number of calcqu or makemap processes to run
+*        concurrently when creating Stokes parameter time-streams or
+*        individual observation maps. For makemap, concurrent processing
+*        is only used once the value to use for the PCA.PCATHRESH config
+*        parameter is known (i.e. after the first map has been created
+*        successfully if the default PCA.PCATHRESH value is being used).
+*        It is not used for makemap if parameter SKYLOOP is TRUE. Each
+*        process requires its own memory, so the value should be chosen
+*        with regard to the memory and number of cores available. [1]
 *     NORTH = LITERAL (Read)
 *        Specifies the celestial coordinate system to use as the reference
 *        direction in any newly created Q and U time series files. For
@@ -803,10 +813,11 @@
 
 '''
 
-import glob
 import os
+import re
 import math
 import shutil
+import concurrent.futures
 import starutil
 import numpy as np
 from starutil import invoke
@@ -818,6 +829,9 @@ from starutil import msg_log
 from starutil import append_logfile
 from starutil import AtaskError
 from starutil import get_fits_header
+from starutil import get_fits_headers
+from starutil import set_fits_headers
+from starutil import forget_fits_headers
 from starutil import get_task_par
 
 #  Assume for the moment that we will not be retaining temporary files.
@@ -827,6 +841,112 @@ retain = 0
 #  create the 850 um beam.
 kernel = None
 
+#  Regular expressions matching the names of the auto-masked (lower case)
+#  and ext-masked (upper case) I, Q and U maps created by makemap.
+automap_re = re.compile( r".*[iqu]map\.sdf$" )
+extmap_re = re.compile( r".*[IQU]map\.sdf$" )
+
+#  A regular expression matching the names of the Q, U and I time-stream
+#  files created by calcqu. The groups are the wavelength digit, the
+#  subarray letter, the observation identifier (<UT>_<OBS>) and the Stokes
+#  parameter suffix.
+timestream_re = re.compile( r"^s(\d)([abcd])(\d+_\d+)_.*_(QT|UT|IT)\.sdf$" )
+
+#  The nominal beam FCFs (Jy/beam/pW) for each SCUBA-2 waveband. Each value
+#  is a list of (enddate,fcf) tuples in date order, where "enddate" is the
+#  UT date (YYYYMMDD) at which the FCF stopped being used (None for the
+#  current FCF).
+nomfcf_table = { 450: [ (20180630, 531.0), (None, 472.0) ],
+                 850: [ (20161101, 525.0), (20180630, 516.0), (None, 495.0) ] }
+
+#  A translation table that removes spaces from a string.
+units_trans = str.maketrans( "", "", " " )
+
+#  The number of arc-seconds in one radian.
+rad2arcsec = math.degrees( 1.0 )*3600.0
+
+#  A dictionary holding the PCA.PCATHRESH values read from previously
+#  examined maps. The key is a tuple containing the map path and its
+#  modification time, so any map that is re-created by makemap will be
+#  re-examined. The value is None for maps from which no value could be
+#  read.
+pcathresh_cache = {}
+
+#  The command used to get the PCA.PCATHRESH value used to create a map.
+#  Environment variables within the command are expanded by the shell
+#  that runs the command, not by this script.
+pcathresh_cmd = ( "$KAPPA_DIR/configecho name=pca.pcathresh ndf={0} config=! "
+                  "application=makemap defaults=$SMURF_DIR/smurf_makemap.def" )
+
+#  A dictionary holding the values of config parameters obtained from
+#  user-supplied configs using configecho. The key is a tuple containing
+#  the config and the parameter name. The value is the string returned by
+#  configecho ("<***>" if the parameter is not defined in the config).
+config_cache = {}
+
+#  Fixed text for the makemap config files created by this script. The
+#  common config holds parameters used when creating all maps, followed by
+#  parameters that depend on the type of masking. The PCA.PCATHRESH value,
+#  which is the only value that varies from run to run, is appended
+#  separately after these.
+conf_common = """^$STARLINK_DIR/share/smurf/.dimmconfig_pol2.lis
+numiter = -200
+modelorder = (com,gai,pca,ext,flt,ast,noi)
+maptol = 0.05
+maptol_mask = <undef>
+maptol_mean = 0
+maptol_box = 60
+maptol_hits = 1
+ast.mapspike_freeze = 5
+pca.zero_niter = 0.5
+com.zero_niter = 0.5
+flt.zero_niter = 0.5
+com.freeze_flags = 30
+"""
+
+conf_automask = """ast.skip = 10
+ast.zero_snr = 3
+ast.zero_snrlo = 2
+ast.zero_freeze = 0.2
+pca.zero_snr = 5
+pca.zero_snrlo = 3
+pca.zero_freeze = -1
+com.zero_snr = 5
+com.zero_snrlo = 3
+com.zero_freeze = -1
+flt.zero_snr = 5
+flt.zero_snrlo = 3
+flt.zero_freeze = -1
+"""
+
+conf_circlemask = """ast.zero_circle = (0.0083)
+pca.zero_circle = (0.0083)
+com.zero_circle = (0.0083)
+flt.zero_circle = (0.0083)
+"""
+
+conf_extmask = """ast.zero_mask = mask2
+"""
+
+conf_pcamask = """pca.zero_mask = mask3
+com.zero_mask = mask3
+flt.zero_mask = mask3
+"""
+
+#  Values that are absolutely required by this script, and which are
+#  appended to the end of the I and Q/U config files.
+conf_required = """noi.usevar=1
+flagslow=0.01
+downsampscale=0
+"""
+
+#  Values appended to the I config file to reset mask SNR thresholds when
+#  the masks are derived from an external signal map.
+conf_snrreset = """ast.zero_snr=0
+pca.zero_snr=0
+flt.zero_snr=0
+com.zero_snr=0
+"""
 
 
 
@@ -860,6 +980,7 @@ def StoreNomFCF( maps, coadd, filter ):
       invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=NOMFCF edit=a value={1} "
              "comment=\"'[Jy/beam/pW] Nominal beam FCF for map'\""
              " position=! mode=interface".format(coadd,nomfcf))
+      forget_fits_headers( coadd )
 
 
 
@@ -868,7 +989,8 @@ def StoreNomFCF( maps, coadd, filter ):
 def GetNomFCF( map, filter ):
 
 #  Get the nominal beam FCF header from the NOMFCF FITS header in the map.
-   nomfcf = get_fits_header( map, "NOMFCF" )
+   headers = get_fits_headers( map )
+   nomfcf = headers.get( "NOMFCF" )
    if nomfcf is not None:
       nomfcf = float( nomfcf )
 
@@ -876,9 +998,9 @@ def GetNomFCF( map, filter ):
 #  observation, stored int he UTDATE header (use DATE-OBS if UTDATE is
 #  not available).
    else:
-      utdate = get_fits_header( map, "UTDATE" )
+      utdate = headers.get( "UTDATE" )
       if utdate is None:
-         dateobs = get_fits_header( map, "DATE-OBS" )
+         dateobs = headers.get( "DATE-OBS" )
          if dateobs is not None:
             (date,time) = dateobs.split("T")
             utdate = float( date.replace("-","") )
@@ -888,28 +1010,84 @@ def GetNomFCF( map, filter ):
                    format(map))
       utdate = float( utdate )
 
-      if filter == 450:
-         if utdate < 20180630:
-            nomfcf = 531.0
-         else:
-            nomfcf = 472.0
-      else:
-         if utdate < 20161101:
-            nomfcf = 525.0
-         elif utdate < 20180630:
-            nomfcf = 516.0
-         else:
-            nomfcf = 495.0
+      for (enddate,nomfcf) in nomfcf_table[ 450 if filter == 450 else 850 ]:
+         if enddate is None or utdate < enddate:
+            break
    return nomfcf
 
+#  A function to get the units and the pixel dimensions (in arc-seconds)
+#  of a sky map without running any atasks, using the starlink.ndfpack
+#  and starlink.Ast modules. The first two WCS axes must be sky axes (any
+#  further axes, such as the degenerate spectral axis in maps created by
+#  makemap, are ignored). The pixel dimensions are measured at the centre
+#  of the first pixel. Returns a tuple (units,xsize,ysize), or None if the
+#  modules are not available or the map is not a sky map.
+def MapInfo( ndf ):
+   try:
+      import starlink.Ast as Ast
+      from starlink.ndfpack import Ndf
+      indf = Ndf( NdfPath( ndf ) )
+      units = indf.units
+      wcs = indf.wcs
+      frame = wcs.getframe( Ast.CURRENT )
+      if wcs.Nin < 2 or frame.Naxes < 2:
+         return None
+      if frame.Naxes > 2:
+         frame = frame.pickaxes( [ 1, 2 ] )[ 0 ]
+      if not isinstance( frame, Ast.SkyFrame ):
+         return None
+
+      grid = np.ones( ( wcs.Nin, 3 ) )
+      grid[ 0, 1 ] = 2.0
+      grid[ 1, 2 ] = 2.0
+      sky = wcs.tran( grid )[ : 2, : ]
+      xsize = frame.distance( sky[ :, 0 ], sky[ :, 1 ] )*rad2arcsec
+      ysize = frame.distance( sky[ :, 0 ], sky[ :, 2 ] )*rad2arcsec
+   except Exception:
+      return None
+
+   if units is None:
+      units = ""
+   return ( units, xsize, ysize )
+
+#  A function to get the pixel dimensions of a sky map, in arc-seconds. They
+#  are obtained in-process if possible, and using ndftrace otherwise.
+def PixelSize( ndf ):
+   info = MapInfo( ndf )
+   if info is not None:
+      return info[ 1 : ]
+
+   invoke("$KAPPA_DIR/ndftrace ndf={0} quiet=yes".format(ndf) )
+   return tuple( float( v ) for v in
+                 get_task_par( "FPIXSCALE", "ndftrace" )[ : 2 ] )
+
+
+
+#  A function to return a units string in a canonical form, so that
+#  equivalent units strings can be compared directly. Spaces are removed,
+#  and "^" is replaced by "**".
+def CanonUnits( units ):
+   return units.translate( units_trans ).replace( "^", "**" )
+
+
+
 #  A function to check the pixel size and units of a map and report an error
 #  if either is not the required value.
 def CheckNDF( param, ndf, pixsize, units ):
    if ndf:
-      invoke("$KAPPA_DIR/ndftrace ndf={0}".format(ndf) )
+
+#  Get the units and pixel dimensions in-process if possible. Otherwise
+#  use ndftrace.
+      info = MapInfo( ndf )
+      if info is None:
+         invoke("$KAPPA_DIR/ndftrace ndf={0}".format(ndf) )
+         (xsize,ysize) = [ float( v ) for v in
+                           get_task_par( "FPIXSCALE", "ndftrace" )[ : 2 ] ]
+         ndfunits = starutil.get_task_par( "UNITS", "ndftrace" )
+      else:
+         (ndfunits,xsize,ysize) = info
+
       if pixsize:
-         xsize = float(get_task_par( "FPIXSCALE(1)", "ndftrace" ))
-         ysize = float(get_task_par( "FPIXSCALE(2)", "ndftrace" ))
          if abs( pixsize - xsize ) > 0.05 or abs( pixsize - ysize ) > 0.05:
             if xsize == ysize:
                raise starutil.InvalidParameterError("NDF '{0}' supplied for "
@@ -920,8 +1098,8 @@ def CheckNDF( param, ndf, pixsize, units ):
                   "parameter {1} has pixel dimensions ({2},{3}) arcsec, but "
                   "parameter PIXSIZE has value {4} arcsec.".format(ndf,param,xsize,ysize,pixsize))
       if units:
-         value = starutil.get_task_par( "UNITS", "ndftrace" ).replace(" ", "")
-         if value != units:
+         value = CanonUnits( ndfunits )
+         if value != CanonUnits( units ):
                raise starutil.InvalidParameterError("NDF '{0}' supplied for "
                   "parameter {1} has units '{2}' - units must be '{3}'."
                   .format(ndf,param,value,units))
@@ -979,9 +1157,7 @@ def Smooth450( inmap, outmap ):
    if kernel is None:
 
 #  Get the input pixel size.
-      invoke("$KAPPA_DIR/ndftrace ndf={0}".format(inmap) )
-      xsize = float(get_task_par( "FPIXSCALE(1)", "ndftrace" ))
-      ysize = float(get_task_par( "FPIXSCALE(2)", "ndftrace" ))
+      (xsize,ysize) = PixelSize( inmap )
       pixsize = math.sqrt( xsize*ysize )
 
 #  Create a pair of NDFs holding the expected model beam shape at
@@ -1032,30 +1208,753 @@ def median(lst):
 #  recent auto-masked or ext-masked map.
 def getPcaThresh( mapdir, automask ):
    if automask:
-      base = "[iqu]map"
+      pattern = automap_re
    else:
-      base = "[IQU]map"
+      pattern = extmap_re
 
+#  Scan the directory to find the oldest candidate map, ignoring any maps
+#  from which a PCA.PCATHRESH value could not previously be read. No list
+#  of candidates is formed. Maps that disappear before they can be
+#  examined are ignored.
    pcathresh = 0
    this_map = None
-   nsecmin = 1E30
-   for tmap in glob.glob("{0}/*{1}.sdf".format(mapdir, base )):
-      nsec = os.path.getmtime( tmap )
-      if nsec < nsecmin:
+   while True:
+      best_mtime = math.inf
+      best_path = None
+      try:
+         with os.scandir( mapdir ) as it:
+            for entry in it:
+               if pattern.match( entry.name ):
+                  try:
+                     mtime = entry.stat().st_mtime
+                  except OSError:
+                     continue
+                  if( mtime < best_mtime and
+                      pcathresh_cache.get( (entry.path,mtime), 0 ) is not None ):
+                     best_mtime = mtime
+                     best_path = entry.path
+      except OSError:
+         pass
+
+      if best_path is None:
+         break
+
+#  Use configecho to get the pca.pcathresh value from the oldest map,
+#  unless it has already been found. If it cannot be found, the map is
+#  recorded as unusable and the directory is scanned again. Usually
+#  configecho is run only once, if at all.
+      cache_key = ( best_path, best_mtime )
+      if cache_key not in pcathresh_cache:
          try:
-            pcathresh = float( invoke("$KAPPA_DIR/configecho name=pca.pcathresh "
-                                      "ndf={0} config=! application=makemap "
-                                      "defaults=$SMURF_DIR/smurf_makemap.def"
-                                      .format(tmap)))
-            nsecmin = nsec
-            this_map = tmap
+            pcathresh_cache[ cache_key ] = float( invoke( pcathresh_cmd.
+                                                          format(best_path) ) )
          except starutil.AtaskError:
-            pass
+            pcathresh_cache[ cache_key ] = None
+
+      if pcathresh_cache[ cache_key ] is not None:
+         pcathresh = pcathresh_cache[ cache_key ]
+         this_map = best_path
+         break
 
    return (pcathresh,this_map)
 
 
 
+#  A function to return the value of a named parameter in a user-supplied
+#  config, as a string. Each distinct config parameter is obtained using
+#  configecho only once. The supplied default is returned if the config
+#  does not define the parameter or cannot be read.
+def ConfigValue( config, name, default=None ):
+   key = ( config, name.lower() )
+   if key not in config_cache:
+      try:
+         config_cache[key] = invoke("$KAPPA_DIR/configecho name={0} "
+                                    "config={1}".format(name,config)).strip()
+      except starutil.AtaskError:
+         config_cache[key] = "<***>"
+
+   value = config_cache[key]
+   return default if ( not value or "<***>" in value ) else value
+
+
+
+#  A function to return the floating point value of a named parameter in a
+#  user-supplied config. The supplied default is returned if the config
+#  does not define the parameter or the value is not numerical.
+def ConfigFloat( config, name, default ):
+   try:
+      return float( ConfigValue( config, name, default ) )
+   except ( TypeError, ValueError ):
+      return default
+
+
+
+#  A function to write the supplied text to a config file in a single
+#  write.
+def WriteConfig( path, text ):
+   with open( path, "w" ) as fd:
+      fd.write( text )
+
+
+
+#  A function to return a set holding the names of all the files in a
+#  directory. An empty set is returned if the directory cannot be read.
+def ListDir( dir ):
+   try:
+      with os.scandir( dir ) as it:
+         return set( entry.name for entry in it )
+   except OSError:
+      return set()
+
+
+
+#  A function to return the path to a single NDF, suitable for use with
+#  the starlink.ndfpack module. The NDF may be specified by an NDG (the
+#  first NDF in the group is used) or a string. Any shell quotes are
+#  removed.
+def NdfPath( ndf ):
+   if isinstance( ndf, NDG ):
+      return ndf[ 0 ]
+   return starutil.shell_quote( "{0}".format( ndf ), True )
+
+
+
+#  A function to read an array component ("data" or "var") of an NDF into
+#  a numpy array using the starlink.ndfpack module. Any degenerate axes are
+#  removed, and bad values are returned as NaN. None is returned if the
+#  starlink.ndfpack module is not available or the NDF cannot be read.
+def ReadData( ndf, comp="data" ):
+   try:
+      from starlink.ndfpack import Ndf
+   except ImportError:
+      return None
+
+   try:
+      raw = np.asarray( getattr( Ndf( NdfPath( ndf ) ), comp ) )
+   except Exception:
+      return None
+
+   return np.squeeze( BadToNaN( raw ) )
+
+
+
+#  A function to return a floating point copy (double precision by
+#  default) of a numpy array read from an NDF, in which any Starlink bad
+#  values have been replaced by NaN.
+def BadToNaN( raw, dtype=np.float64 ):
+   data = np.array( raw, dtype=dtype )
+   if np.issubdtype( raw.dtype, np.floating ):
+      data[ raw == np.finfo( raw.dtype ).min ] = np.nan
+   elif np.issubdtype( raw.dtype, np.signedinteger ):
+      data[ raw == np.iinfo( raw.dtype ).min ] = np.nan
+   elif np.issubdtype( raw.dtype, np.unsignedinteger ):
+      data[ raw == np.iinfo( raw.dtype ).max ] = np.nan
+   return data
+
+
+
+#  A function to return the number of good values in the data array of an
+#  NDF. The data array is read using the starlink.ndfpack module if
+#  possible, and KAPPA:STATS is used otherwise. An AtaskError is raised
+#  if the NDF contains no good values, as is done by KAPPA:STATS.
+def NumGood( ndf ):
+   data = ReadData( ndf )
+   if data is not None:
+      ngood = int( np.count_nonzero( ~np.isnan( data ) ) )
+      if ngood == 0:
+         raise starutil.AtaskError("No good values found in {0}".format(ndf))
+   else:
+      invoke("$KAPPA_DIR/stats ndf={0}".format(ndf))
+      ngood = get_task_par( "numgood", "stats" )
+   return float( ngood )
+
+
+
+#  A function to store a numpy array in an array component ("DATA" or
+#  "VARIANCE") of an existing NDF using the starlink.ndf module. The array
+#  must have the same shape as the NDF (in numpy axis order). Single
+#  precision arrays are mapped as _REAL and all others as _DOUBLE. NaN
+#  values are stored as bad values.
+def WriteArray( ndf, comp, array ):
+   from starlink import ndf as pyndf
+   if array.dtype == np.float32:
+      (htype,dtype) = ( '_REAL', np.float32 )
+   else:
+      (htype,dtype) = ( '_DOUBLE', np.float64 )
+   array = np.where( np.isnan( array ), np.finfo( dtype ).min, array )
+   pyndf.begin()
+   try:
+      indf = pyndf.open( ndf, 'UPDATE', 'OLD' )
+      mapped = indf.map( comp, htype, 'WRITE' )
+      mapped.numpytondf( np.ascontiguousarray( array, dtype=dtype ) )
+      indf.unmap( comp )
+      indf.annul()
+   finally:
+      pyndf.end()
+
+
+
+#  A function to find the pixel grid of an NDF using the starlink.ndfpack
+#  and starlink.Ast modules. Returns a tuple holding the pixel lower bounds
+#  (in numpy axis order), the Mapping from PIXEL coordinates to the current
+#  WCS Frame, and the Ndf object itself.
+def PixelGrid( ndf ):
+   import starlink.Ast as Ast
+   from starlink.ndfpack import Ndf
+
+   indf = Ndf( NdfPath( ndf ) )
+   wcs = indf.wcs
+   for ipix in range( 1, wcs.Nframe + 1 ):
+      if wcs.getframe( ipix ).Domain == "PIXEL":
+         break
+   else:
+      raise starutil.InvalidParameterError("No PIXEL Frame in {0}".format(ndf))
+
+#  The centre of the first pixel is at GRID coordinate 1 on every axis,
+#  and at PIXEL coordinate (lbnd-0.5).
+   pix = wcs.getmapping( Ast.BASE, ipix ).tran( np.ones( ( wcs.Nin, 1 ) ) )
+   lbnd = [ int( round( x + 0.5 ) ) for x in pix[ :, 0 ] ]
+   lbnd.reverse()
+
+   return ( lbnd, wcs.getmapping( ipix, Ast.CURRENT ), indf )
+
+
+
+#  A function to return the pixel bounds of an NDF, as a tuple holding
+#  lists of the lower and upper bounds on each pixel axis (in NDF axis
+#  order). The bounds are obtained in-process if possible, and using
+#  ndftrace otherwise.
+def PixelBounds( ndf ):
+#  The "bound" attribute of an ndfpack Ndf holds the lower and upper
+#  bounds in Python (i.e. reversed) axis order.
+   try:
+      from starlink.ndfpack import Ndf
+      bound = Ndf( NdfPath( ndf ) ).bound
+      lbnd = [ int( v ) for v in reversed( bound[ 0 ] ) ]
+      ubnd = [ int( v ) for v in reversed( bound[ 1 ] ) ]
+      return ( lbnd, ubnd )
+   except Exception:
+      pass
+
+   invoke("$KAPPA_DIR/ndftrace ndf={0} quiet=yes".format(ndf))
+   lbnd = get_task_par( "LBOUND", "ndftrace" )
+   ubnd = get_task_par( "UBOUND", "ndftrace" )
+   if not isinstance( lbnd, list ):
+      lbnd = [ lbnd ]
+      ubnd = [ ubnd ]
+   return ( [ int( v ) for v in lbnd ], [ int( v ) for v in ubnd ] )
+
+
+
+#  A function to check that a set of maps are all on the same pixel grid
+#  (i.e. they have the same PIXEL->WCS Mapping, but possibly different
+#  pixel bounds). The output region is defined by the pixel bounds of the
+#  reference map "ref" if supplied, or the union of the bounds of all the
+#  maps otherwise. The first map defines the pixel grid if "ref" is None.
+#  Returns a tuple holding a list of tuples (one for each map) and the
+#  lower pixel bounds and shape of the output region. Each tuple in the
+#  list holds the numpy slices that select the overlap of the map with the
+#  output region, in both the map and the output region, together with
+#  the map's Ndf object. None is returned if the maps are not all on the
+#  same pixel grid.
+def GridOverlaps( maps, ref=None ):
+   grids = [ PixelGrid( map ) for map in maps ]
+   shapes = [ np.shape( grid[2].data ) for grid in grids ]
+
+   if ref is not None:
+      (rlbnd,rmap,rndf) = PixelGrid( ref )
+      rshape = np.shape( rndf.data )
+   else:
+      rmap = grids[0][1]
+      rlbnd = [ min( grid[0][i] for grid in grids )
+                for i in range( len( shapes[0] ) ) ]
+      rshape = tuple( max( grid[0][i] + shape[i] for grid,shape in zip( grids, shapes ) ) - rlbnd[i]
+                      for i in range( len( shapes[0] ) ) )
+
+#  Test positions at the corners and centre of the output region.
+   test = []
+   for corner in ( 0.0, 0.5, 1.0 ):
+      test.append( [ rlbnd[i] - 1.0 + corner*rshape[i]
+                     for i in reversed( range( len( rlbnd ) ) ) ] )
+   test = np.array( test ).T
+   rwcs = rmap.tran( test )
+
+   overlaps = []
+   for (lbnd,mmap,mndf),shape in zip( grids, shapes ):
+      if len( shape ) != len( rshape ):
+         return None
+      if not np.allclose( mmap.tran( test ), rwcs, rtol=1.0E-9, atol=1.0E-9 ):
+         return None
+
+      rslice = []
+      mslice = []
+      for i in range( len( shape ) ):
+         lo = max( lbnd[i], rlbnd[i] )
+         hi = min( lbnd[i] + shape[i], rlbnd[i] + rshape[i] )
+         if hi <= lo:
+            lo = hi = rlbnd[i]
+         rslice.append( slice( lo - rlbnd[i], hi - rlbnd[i] ) )
+         mslice.append( slice( lo - lbnd[i], hi - lbnd[i] ) )
+      overlaps.append( ( tuple( mslice ), tuple( rslice ), mndf ) )
+
+   return ( overlaps, rlbnd, rshape )
+
+
+
+#  A function to accumulate the inverse-variance weighted mean of a set of
+#  maps on a common pixel grid, as returned by GridOverlaps. "weights" is
+#  None, or a list holding an extra weight for each map. The maps are read
+#  one at a time, and a weighted form of Welford's algorithm is used, so
+#  the memory needed does not depend on the number of maps. All arrays are
+#  single precision, matching the maps created by makemap, which halves the
+#  memory traffic compared to double precision. To avoid overflow when
+#  squaring the weights, all weights are scaled so that a typical weight
+#  in the first map is unity (the results do not depend on the scaling).
+#  Returns the
+#  weighted mean and two variance estimates - one propagated from the
+#  input variances and one derived from the spread of input data values
+#  (equivalent to wcsmosaic with genvar=no and genvar=yes respectively).
+#  Output pixels that receive no good input values (or less than two
+#  values for the second variance estimate) are returned holding NaN.
+def AccumulateMaps( overlaps, shape, weights=None ):
+   f32 = np.float32
+   sumw = np.zeros( shape, dtype=f32 )
+   sumw2 = np.zeros( shape, dtype=f32 )
+   sumw2v = np.zeros( shape, dtype=f32 )
+   mean = np.zeros( shape, dtype=f32 )
+   m2 = np.zeros( shape, dtype=f32 )
+   scale = None
+
+   for imap,(mslice,rslice,mndf) in enumerate( overlaps ):
+      d = BadToNaN( mndf.data[ mslice ], f32 )
+      v = BadToNaN( mndf.var[ mslice ], f32 )
+      good = np.isfinite( d ) & np.isfinite( v ) & ( v > 0 )
+      if scale is None and good.any():
+         scale = f32( np.median( v[ good ] ) )
+      w = np.zeros( d.shape, dtype=f32 )
+      np.divide( scale if scale else f32( 1.0 ), v, out=w, where=good )
+      if weights is not None:
+         w *= f32( weights[ imap ] )
+      d[ ~good ] = 0.0
+      v[ ~good ] = 0.0
+
+      tsumw = sumw[ rslice ] + w
+      delta = d - mean[ rslice ]
+      ratio = np.divide( w, tsumw, out=np.zeros( d.shape, dtype=f32 ),
+                         where=( tsumw > 0 ) )
+      mean[ rslice ] += ratio*delta
+      m2[ rslice ] += w*delta*( d - mean[ rslice ] )
+      sumw[ rslice ] = tsumw
+      sumw2[ rslice ] += w*w
+      sumw2v[ rslice ] += w*w*v
+
+   ok = sumw > 0
+   mean[ ~ok ] = np.nan
+
+   var = np.full( shape, np.nan, dtype=f32 )
+   var[ ok ] = sumw2v[ ok ] / ( sumw[ ok ]*sumw[ ok ] )
+
+#  The variance of the weighted mean derived from the spread of values,
+#  using the effective number of samples implied by the weights.
+   denom = sumw*sumw - sumw2
+   genvar = np.full( shape, np.nan, dtype=f32 )
+   ok = denom > 0
+   genvar[ ok ] = ( m2[ ok ]/sumw[ ok ] )*( sumw2[ ok ]/denom[ ok ] )
+
+   return ( mean, var, genvar )
+
+
+
+#  A function to replace the Variance component of an existing coadd with
+#  the variance of the weighted mean of a set of observation maps, derived
+#  from the spread of their data values. This is equivalent to running
+#  wcsmosaic with "method=near variance=yes genvar=yes" and then copying
+#  the variances into the coadd using setvar, but avoids creating a new
+#  mosaic. Returns False if the numpy route cannot be used (e.g. the
+#  starlink.ndfpack module is not available or the maps are not all on the
+#  same pixel grid as the coadd), in which case nothing is changed.
+def MapVariance( maps, coadd ):
+   try:
+      result = GridOverlaps( maps, coadd[0] )
+      if result is None:
+         return False
+      (overlaps,lbnd,shape) = result
+      (mean,var,genvar) = AccumulateMaps( overlaps, shape )
+      WriteArray( coadd[0], "VARIANCE", genvar )
+   except Exception:
+      return False
+
+   return True
+
+
+
+#  A function to create a mosaic of a set of maps that are all on the same
+#  pixel grid, using numpy. The pixel values are the same as those created
+#  by running wcsmosaic with "lbnd=! ref=! conserve=no method=near
+#  variance=yes", with the supplied "genvar" value and optional per-map
+#  weights. The output NDF is created by copying the Data component of the
+#  first map and changing its bounds to enclose all maps, and then storing
+#  the new Data and Variance values in it. All the maps are recorded as
+#  parents in the provenance of the output NDF, as done by wcsmosaic,
+#  although its history records the ndfcopy, setbound and provadd
+#  commands rather than wcsmosaic. Returns False if the numpy route cannot be used (e.g. the
+#  starlink.ndfpack module is not available or the maps are not all on the
+#  same pixel grid), in which case no output NDF is created.
+def NumpyMosaic( maps, out, weights=None, genvar=False ):
+   try:
+      result = GridOverlaps( maps )
+      if result is None:
+         return False
+      (overlaps,lbnd,shape) = result
+      (mean,var,gvar) = AccumulateMaps( overlaps, shape, weights )
+   except Exception:
+      return False
+
+   invoke("$KAPPA_DIR/ndfcopy in={0} out={1} comp=data".format(maps[0],out))
+   bounds = ",".join( "{0}:{1}".format( lbnd[i], lbnd[i] + shape[i] - 1 )
+                      for i in reversed( range( len( shape ) ) ) )
+   invoke("$KAPPA_DIR/setbound ndf={0}'({1})'".format(out,bounds))
+
+   try:
+      WriteArray( out[0], "DATA", mean )
+      WriteArray( out[0], "VARIANCE", gvar if genvar else var )
+   except Exception:
+      invoke("$KAPPA_DIR/erase object={0} ok=yes".format(out))
+      return False
+
+#  The output NDF inherits provenance from the first map only, since it
+#  was created from it by ndfcopy. Record the other maps as parents too,
+#  as wcsmosaic would have done.
+   for parent in list( maps )[ 1 : ]:
+      invoke("$KAPPA_DIR/provadd ndf={0} parent={1}".format(out,parent))
+
+   return True
+
+
+
+#  A function to return the FellWalker Noise and MinHeight values to use
+#  for the step following the supplied values, when searching for a mask
+#  that does not contain too many source pixels.
+def NextMaskStep( noise, minheight ):
+   if noise == minheight:
+      minheight *= 1.2
+   return (minheight, minheight)
+
+
+
+#  A function to estimate the FellWalker Noise and MinHeight values at
+#  which the mask created by findclumps from the supplied SNR map first
+#  contains fewer than "maxgood" source pixels. Each step raises the
+#  thresholds as done by NextMaskStep. Each FellWalker clump is
+#  approximated by a connected region of pixels above "noise" that
+#  contains at least one pixel above "minheight" and at least 7 pixels
+#  (the default FellWalker.MinPix value). If numpy and scipy cannot be
+#  used to read and label the SNR map, a cruder estimate is made using the
+#  SNR value exceeded by "maxgood" of the "numgood" good pixels in the SNR
+#  map. Returns a list holding the (Noise,MinHeight) values for every step
+#  from the supplied step up to the step before the estimated step. Since
+#  the result is only an estimate, FindMask should be used to confirm it.
+def EstimateMaskThresholds( snr, noise, minheight, maxgood, numgood ):
+   steps = [ (noise, minheight) ]
+
+   try:
+      from scipy import ndimage
+      data = ReadData( snr )
+   except ImportError:
+      data = None
+
+   if data is None:
+      if numgood <= 0 or maxgood >= numgood:
+         return steps
+      try:
+         invoke("$KAPPA_DIR/histat ndf={0} percentiles={1}".
+                format( snr, 100.0*( 1.0 - maxgood/numgood ) ) )
+         peak = float( get_task_par( "perval(1)", "histat" ) )
+      except ( starutil.AtaskError, TypeError, ValueError ):
+         return steps
+
+      while 0 < minheight < peak:
+         (noise, minheight) = NextMaskStep( noise, minheight )
+         steps.append( (noise, minheight) )
+      return steps[ : max( 1, len( steps ) - 1 ) ]
+
+   data[ np.isnan( data ) ] = -np.inf
+
+   structure = np.ones( (3,)*data.ndim )
+   while True:
+      labels, nlab = ndimage.label( data > noise, structure )
+      if nlab == 0:
+         break
+
+#  Find the size and peak value of each labelled region in a single pass
+#  through the labelled pixels. Element zero refers to unlabelled pixels.
+      inreg = labels > 0
+      reglab = labels[ inreg ]
+      sizes = np.bincount( reglab, minlength=nlab + 1 )
+      peaks = np.full( nlab + 1, -np.inf )
+      np.maximum.at( peaks, reglab, data[ inreg ] )
+      ngood = sizes[ ( peaks >= minheight ) & ( sizes >= 7 ) ].sum()
+      if ngood < maxgood or ngood == 0:
+         break
+
+      (noise, minheight) = NextMaskStep( noise, minheight )
+      steps.append( (noise, minheight) )
+
+   return steps[ : max( 1, len( steps ) - 1 ) ]
+
+
+
+#  A function to create a mask from an SNR map using findclumps, with the
+#  supplied FellWalker Noise and MinHeight values. Returns the number of
+#  source pixels in the mask. An AtaskError is raised if there are none.
+def MaskFromSNR( snr, mask, fwconf, noise, minheight ):
+   invoke("$CUPID_DIR/findclumps in={0} method=fellwalker rms=1 "
+          "outcat=! out={1} config=\"'^{2},FellWalker.Noise={3},"
+          "FellWalker.MinHeight={4}'\"".format(snr,mask,fwconf,noise,
+                                                minheight))
+   return NumGood( mask )
+
+
+
+#  A function to create the mask for the first step that gives fewer than
+#  "maxgood" source pixels, where "steps" is the list returned by
+#  EstimateMaskThresholds. Raising both thresholds cannot add source
+#  pixels to the mask (the original step-by-step search relies on this
+#  too), so the result is the same as trying each step in turn from the
+#  first. The search starts at the last supplied step. If this already
+#  gives few enough source pixels, the estimate has skipped too far, so
+#  step backwards until a step gives too many source pixels (or the first
+#  step is reached), and use the step following it. Otherwise, step
+#  forwards until a step gives few enough source pixels. Returns the
+#  number of source pixels in the mask. An AtaskError is raised if the
+#  mask contains no source pixels.
+def FindMask( snr, mask, fwconf, steps, maxgood ):
+   istep = len( steps ) - 1
+   (noise, minheight) = steps[ istep ]
+   ngood = MaskFromSNR( snr, mask, fwconf, noise, minheight )
+
+   if ngood < maxgood:
+      while istep > 0:
+         prevgood = MaskFromSNR( snr, mask, fwconf, *steps[ istep - 1 ] )
+         if prevgood >= maxgood:
+            ngood = MaskFromSNR( snr, mask, fwconf, *steps[ istep ] )
+            break
+         istep -= 1
+         ngood = prevgood
+
+   else:
+      while ngood >= maxgood:
+         (noise, minheight) = NextMaskStep( noise, minheight )
+         ngood = MaskFromSNR( snr, mask, fwconf, noise, minheight )
+
+   return ngood
+
+
+
+#  A function to run a command (e.g. makemap) in a separate thread. It is
+#  used to create several observation maps concurrently, amongst other
+#  things. Each process is given its own ADAM_USER directory so that
+#  concurrent processes do not interfere with each others parameter files.
+#  The output is buffered so that the screen output from different
+#  processes is not interleaved. Returns True if the command succeeded and
+#  False otherwise.
+def RunTask( cmd, adamdir ):
+   try:
+      invoke( cmd, buffer=True, env={ "ADAM_USER": adamdir } )
+      return True
+   except starutil.AtaskError:
+      return False
+
+
+
+#  A function to run a list of independent commands concurrently, using up
+#  to "nprocs" threads. Each command uses its own ADAM_USER directory and
+#  its output is buffered (see RunTask). Returns a list of flags
+#  indicating which commands succeeded.
+def InvokeConcurrently( cmds, nprocs ):
+   with concurrent.futures.ThreadPoolExecutor( max_workers=max( 1, nprocs ) ) as pool:
+      futures = [ pool.submit( RunTask, cmd, NDG.subdir() ) for cmd in cmds ]
+      return [ future.result() for future in futures ]
+
+
+
+#  A function to return the total size in bytes of the files holding a
+#  list of NDFs. Files that cannot be found are ignored.
+def DataSize( ndfs ):
+   size = 0
+   for ndf in ndfs:
+      path = ndf if ndf.endswith(".sdf") else ndf+".sdf"
+      try:
+         size += os.path.getsize( path )
+      except OSError:
+         pass
+   return size
+
+
+
+#  A generator that reads a text file listing NDF paths, one per line, and
+#  a corresponding text file created by pol2check holding information
+#  about each NDF. Each line of the two files is read once, and a tuple is
+#  returned for each NDF holding the path followed by the space-separated
+#  fields from the information file.
+def ReadListing( pathfile, infofile ):
+   with open(pathfile) as pfd, open(infofile) as ifd:
+      for (path,info) in zip( pfd, ifd ):
+         yield ( path.strip(), ) + tuple( info.split() )
+
+
+
+#  A function to return a dict describing the Q, U and I time-stream files
+#  in a directory, using a single scan of the directory. Each key is a
+#  tuple (observation identifier, subarray letter, Stokes suffix) and each
+#  value is a sorted list of paths (without the ".sdf" suffix) for the
+#  matching files. Only files for the wavelength selected by "filter" are
+#  included.
+def ListTimeStreams( dir, filter ):
+   w = "{0}".format( filter // 100 )
+   streams = {}
+   for name in sorted( ListDir( dir ) ):
+      match = timestream_re.match( name )
+      if match and match.group(1) == w:
+         key = ( match.group(3), match.group(2), match.group(4) )
+         path = os.path.abspath( os.path.join( dir, name[ : -4 ] ) )
+         streams.setdefault( key, [] ).append( path )
+   return streams
+
+
+
+#  A function to complete the creation of the Stokes parameter time-series
+#  files for a single observation. The supplied "job" is a tuple holding
+#  the observation identifier, a Future for any calcqu process that is
+#  creating the time-series files (None if pre-existing files are being
+#  re-used), and the paths to the text files listing the new Q, U and I
+#  time-series files. This function waits for calcqu to finish, then
+#  appends the new time-series files to the list of all time-series files
+#  in "allquis".
+def FinishCalcqu( job, allquis ):
+   (id,future,new_q,new_u,new_i) = job
+   try:
+      if future is not None:
+         future.result()
+
+      with open(allquis, 'a') as outfile:
+         for fname in ( new_q, new_u, new_i ):
+             if os.path.isfile( fname ):
+                 with open(fname) as infile:
+                    outfile.write(infile.read())
+
+   except starutil.AtaskError as err:
+      CalcquFailed( id, err )
+
+
+
+#  A function to report an error that occurred within calcqu whilst
+#  processing the observation with the supplied identifier. The
+#  observation is named explicitly since, if several calcqu processes are
+#  run concurrently, the output from other observations may have been
+#  displayed since the failed observation was started.
+def CalcquFailed( id, err ):
+   msg_out( err )
+   msg_out( "\nAn error occurred within CALCQU. Observation {0} will be ignored.\n"
+            "Continuing to process any remaining observations...\n".format(id) )
+
+
+
+#  A function to return the symbols for the first two axes of the current
+#  WCS Frame in an NDF. They are obtained in-process using the
+#  starlink.ndfpack module if possible, and using wcsattrib otherwise.
+def AxisSymbols( ndf ):
+   try:
+      from starlink.ndfpack import Ndf
+      wcs = Ndf( NdfPath( ndf ) ).wcs
+      return ( wcs.get( "Symbol(1)" ), wcs.get( "Symbol(2)" ) )
+   except Exception:
+      pass
+
+   return tuple( invoke("$KAPPA_DIR/wcsattrib ndf={0} mode=get name='Symbol({1})'".
+                        format(ndf,iax)) for iax in (1,2) )
+
+
+
+#  A function to return the bad-bits mask that selects the pixels flagged
+#  with a given quality name in an NDF, or zero if the quality name is not
+#  defined. The QUALITY_NAMES extension is read directly from the HDS
+#  container file if possible, and using showqual otherwise.
+def QualityMask( ndf, qname ):
+   try:
+      from starlink import hds
+      loc = hds.open( NdfPath( ndf ), 'READ' )
+      try:
+         qual = loc.find( "MORE" ).find( "QUALITY_NAMES" ).find( "QUAL" )
+         for i in range( qual.shape[ 0 ] ):
+            cell = qual.cell( [ i ] )
+            name = cell.find( "NAME" ).get()
+            if isinstance( name, bytes ):
+               name = name.decode("ascii","ignore")
+            if name.strip().upper() == qname and cell.find( "FIXED" ).get():
+               return 1 << ( int( cell.find( "BIT" ).get() ) - 1 )
+         return 0
+      finally:
+         loc.annul()
+   except Exception:
+      pass
+
+   invoke("$KAPPA_DIR/showqual ndf={0}".format(ndf))
+   for (iname,bb) in ( (1,1), (2,2), (3,4) ):
+      if get_task_par( "QNAMES({0})".format(iname), "showqual" ) == qname:
+         return bb
+   return 0
+
+
+
+#  A function to transform a central and an offset position from the base
+#  (GRID) Frame of a 2D sky map to the current (SKY) Frame, in-process using
+#  pyast, and find the arc-distances between them parallel to each sky axis.
+#  Returns a tuple holding the central and offset sky coordinates and the
+#  two arc-distances, all in radians, or None if the map's WCS cannot be
+#  used in-process.
+def SkyDistances( ndf, cenx, ceny, offx, offy ):
+   try:
+      import starlink.Ast as Ast
+      from starlink.ndfpack import Ndf
+      wcs = Ndf( NdfPath( ndf ) ).wcs
+      frame = wcs.getframe( Ast.CURRENT )
+      if wcs.Nin != 2 or frame.Naxes != 2:
+         return None
+
+      ( (cena,offa), (cenb,offb) ) = wcs.tran( [ [ cenx, offx ], [ ceny, offy ] ] )
+      dista = frame.distance( [ cena, cenb ], [ offa, cenb ] )
+      distb = frame.distance( [ cena, cenb ], [ cena, offb ] )
+   except Exception:
+      return None
+
+   return ( cena, cenb, offa, offb, dista, distb )
+
+
+
+#  A function to complete an observation map after it has been created by
+#  makemap. This smooths it to the 850 um resolution if required, and
+#  stores FITS headers holding the pointing corrections that were used.
+def FinishMap( unsmoothed, obsmap, dx, dy, smooth450 ):
+
+#  If required smooth the output map to the resolution of the 850 um beam.
+   if smooth450:
+      Smooth450( unsmoothed, obsmap )
+
+#  Store FITS headers holding the pointing corrections that were actually
+#  used. Both headers are written in a single edit of the FITS extension.
+   if dx is not None or dy is not None:
+      syms = AxisSymbols( obsmap )
+      comment = "Used {0} pointing correction [arcsec]"
+      headers = []
+      if dx is not None:
+         headers.append( ( "POINT_DX", dx, comment.format( syms[ 0 ] ) ) )
+      if dy is not None:
+         headers.append( ( "POINT_DY", dy, comment.format( syms[ 1 ] ) ) )
+      set_fits_headers( obsmap, headers )
+
+
+
 #  A function to clean up before exiting. Delete all temporary NDFs etc,
 #  unless the script's RETAIN parameter indicates that they are to be
 #  retained. Also delete the script's temporary ADAM directory.
@@ -1094,10 +1993,12 @@ def MakeCoadd( qui, qui_maps, i_maps, coadd, filter, mapvar, automask, obsweight
    if not obsweight:
       msg_out("Coadding {0} maps from all observations with no weighting:".format(qui))
 
-#  Form the coadd using equal weights for all observations.
-      invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
-             "conserve=no method=near variance=yes genvar={2} "
-             .format(allmaps,coadd,mapvar))
+#  Form the coadd using equal weights for all observations. If possible,
+#  do it in memory using numpy rather than running wcsmosaic.
+      if not NumpyMosaic( allmaps, coadd, genvar=mapvar ):
+         invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
+                "conserve=no method=near variance=yes genvar={2} "
+                .format(allmaps,coadd,mapvar))
 
 #  If we are processing I data, determine pointing and calibration corrections
 #  by comparing each individual observation map with the new coadd. These
@@ -1135,9 +2036,12 @@ def MakeCoadd( qui, qui_maps, i_maps, coadd, filter, mapvar, automask, obsweight
             msg_out("     Making new coadd using unit weights...")
          else:
             msg_out("     Making new coadd using improved weights...")
-         invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
-                "conserve=no method=near variance=yes genvar={2} "
-                "weights=^{3}".format(allmaps,this_coadd,mapvar,wfile))
+         with open( wfile ) as fd:
+            wlist = [ float( line ) for line in fd ]
+         if not NumpyMosaic( allmaps, this_coadd, wlist, mapvar ):
+            invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
+                   "conserve=no method=near variance=yes genvar={2} "
+                   "weights=^{3}".format(allmaps,this_coadd,mapvar,wfile))
 
 #  Report the mean error within the central 40 pixels of the coadd
          invoke("$KAPPA_DIR/stats ndf={0}'(0~40,0~40)' comp=err quiet=yes".format(this_coadd) )
@@ -1174,6 +2078,7 @@ def MakeCoadd( qui, qui_maps, i_maps, coadd, filter, mapvar, automask, obsweight
                   invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=CHUNKWGT "
                          "edit=a value={1} comment=\"'Weight for this chunk of data'\""
                          " position=! mode=interface".format(qui_maps[key],wgt))
+                  forget_fits_headers( qui_maps[key] )
                   msg_out("       {0}: {1}".format(key, wgt))
                   fd.write( "{0}\n".format(wgt) )
             msg_out(" ")
@@ -1215,12 +2120,16 @@ def MakeCoadd( qui, qui_maps, i_maps, coadd, filter, mapvar, automask, obsweight
 
       if allone:
          weights = "!"
+         wlist = None
       else:
          weights = "^{0}".format(wfile)
+         with open( wfile ) as fd:
+            wlist = [ float( line ) for line in fd ]
 
-      invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
-             "conserve=no method=near variance=yes genvar={2} "
-             "weights={3}".format(allmaps,coadd,mapvar,weights))
+      if not NumpyMosaic( allmaps, coadd, wlist, mapvar ):
+         invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
+                "conserve=no method=near variance=yes genvar={2} "
+                "weights={3}".format(allmaps,coadd,mapvar,weights))
 
 #  Calculate and store the nominal FCF in the coadd.
    StoreNomFCF( qui_maps, coadd, filter )
@@ -1250,6 +2159,15 @@ def StoreCorrections( qui_maps, imap ):
 #  Loop round all observations.
    comment = None
    msg_out( "     Improved pointing corrections derived using new coadd:" )
+
+#  Scratch NDFs used for each observation in turn. They are over-written
+#  for each observation rather than creating new temporary NDFs each time.
+   aligner_A = NDG( 1 )
+   aligned = NDG( 1 )
+   imap2d = NDG( 1 )
+   walign = ( "$KAPPA_DIR/wcsalign in={0} lbnd=! out={1} ref={2} "
+              "conserve=no method=sincsinc params=\[2,0\] rebin=yes" )
+
    for key in qui_maps:
 
 #  Can't align if we have no reference.
@@ -1276,45 +2194,49 @@ def StoreCorrections( qui_maps, imap ):
 #  first mask out background areas. Use the AST mask to define source pixels,
 #  but only if the mask contains a reasonable number of pixels (very faint
 #  sources will have very small or non-existant AST masks).
-      invoke("$KAPPA_DIR/showqual ndf={0}".format(qui_maps[key]))
-      if get_task_par( "QNAMES(1)", "showqual" ) == "AST":
-         bb = 1
-      elif get_task_par( "QNAMES(2)", "showqual" ) == "AST":
-         bb = 2
-      elif get_task_par( "QNAMES(3)", "showqual" ) == "AST":
-         bb = 4
-      else:
-         bb = 0
-
+      bb = QualityMask( qui_maps[key], "AST" )
       if bb > 0:
          invoke("$KAPPA_DIR/setbb ndf={0} bb={1}".format(qui_maps[key],bb))
 
-#  Clear badbits to use the whole map if the above masking results in too
-#  few pixels, and instead mask the map to remove pixels that have less
-#  than the mean exposure time per pixel.
-      invoke("$KAPPA_DIR/stats ndf={0}".format(qui_maps[key]))
-      nused = float( get_task_par( "numgood", "stats" ) )
-      if nused < 400:
-         invoke("$KAPPA_DIR/setbb ndf={0} bb=0".format(qui_maps[key]))
-         aligner = exptrim( qui_maps[key], 1.0 )
-      else:
-         aligner = qui_maps[key]
-
 #  The individual observation map may not use the same WCS as the coadd
 #  (e.g. different observations of the same source may use different
-#  reference positions), so now align the observation map with the coadd
-#  so that they both use the same pixel grid.
-      aligner_A = NDG( 1 )
-      invoke("$KAPPA_DIR/wcsalign in={0} lbnd=! out={1} ref={2} "
-             "conserve=no method=sincsinc params=\[2,0\] rebin=yes".
-             format(aligner,aligner_A,aref))
+#  reference positions), so we need to align the observation map with the
+#  coadd so that they both use the same pixel grid. The masked map is
+#  nearly always used, so start aligning it in a separate thread (with
+#  its own ADAM_USER directory) while the masked pixels are counted.
+      try:
+         with concurrent.futures.ThreadPoolExecutor( max_workers=1 ) as pool:
+            future = pool.submit( RunTask, walign.format(qui_maps[key],aligner_A,aref),
+                                  NDG.subdir() )
+            invoke("$KAPPA_DIR/stats ndf={0}".format(qui_maps[key]))
+            nused = float( get_task_par( "numgood", "stats" ) )
+            aligned_ok = future.result()
+
+#  Clear badbits to use the whole map if the above masking results in too
+#  few pixels, and instead mask the map to remove pixels that have less
+#  than the mean exposure time per pixel. The aligned masked map created
+#  above is then not used. If the alignment failed above, run it again
+#  here so that any error is reported in the usual way.
+         if nused < 400:
+            if bb > 0:
+               invoke("$KAPPA_DIR/setbb ndf={0} bb=0".format(qui_maps[key]))
+               bb = 0
+            aligner = exptrim( qui_maps[key], 1.0 )
+            invoke( walign.format(aligner,aligner_A,aref) )
+         elif not aligned_ok:
+            invoke( walign.format(qui_maps[key],aligner_A,aref) )
+
+#  Ensure the bad-bits mask has been reset, even if an error occurs. The
+#  aligned map is a separate NDF, so the mask is no longer needed.
+      finally:
+         if bb > 0:
+            invoke("$KAPPA_DIR/setbb ndf={0} bb=0".format(qui_maps[key]))
 
 #  Find the pixel shift that aligns features in this masked, trimmed,
 #  aligned I map with corresponding features in the reference map. Also
 #  get the RMS residual between the two maps after alignment, and store
 #  the corresponding weight.
       try:
-         aligned = NDG(1)
          invoke("$KAPPA_DIR/align2d ref={0} out={2} in={1} form=3 "
                 "method=sincsinc rebin=no conserve=no params=\[0,2\]".
                 format(aref,aligner_A,aligned))
@@ -1354,12 +2276,9 @@ def StoreCorrections( qui_maps, imap ):
          weights[key] = 0.0
          scale = 1.0
 
-#  Ensure the bad-bits mask has been reset.
-      if bb > 0:
-         invoke("$KAPPA_DIR/setbb ndf={0} bb=0".format(qui_maps[key]))
-
 #  If the shifts are suspiciously high, we do not believe them. In which
 #  case we cannot do pointing ocorrection when creating the Q and U maps.
+      headers = []
       if abs(dx) > 8 or abs(dy) > 8:
          msg_out( "\nWARNING: {0}: The I map created from the POL2 data cannot "
                   "be aligned with the supplied reference map. Check the maps "
@@ -1371,56 +2290,56 @@ def StoreCorrections( qui_maps, imap ):
       else:
 
 #  Strip the wavelength axis off the total intensity map created above.
-         imap2d = NDG( 1 )
          invoke("$KAPPA_DIR/ndfcopy in={0} out={1} trim=yes".format(qui_maps[key],imap2d))
 
-#  Get the pixel coords at the centre of the total intensity map.
-         invoke("$KAPPA_DIR/ndftrace ndf={0}".format(imap2d))
-         lbndx = float( get_task_par( "LBOUND(1)", "ndftrace" ) )
-         lbndy = float( get_task_par( "LBOUND(2)", "ndftrace" ) )
-         ubndx = float( get_task_par( "UBOUND(1)", "ndftrace" ) )
-         ubndy = float( get_task_par( "UBOUND(2)", "ndftrace" ) )
-         cenx = 0.5*( lbndx + ubndx )
-         ceny = 0.5*( lbndy + ubndy )
-
-#  Convert to SKY coords, in radians. Use ATOOLS rather than pyast in
-#  order to avoid the need for people to install pyast. Also, ATOOLS
-#  integrates with NDFs more easily than pyast.
-         (cena,cenb) = invoke("$ATOOLS_DIR/asttran2 this={0} forward=yes "
-                              "xin={1} yin={2}".format( imap2d,cenx,ceny)).split()
-         cena = float( cena )
-         cenb = float( cenb )
-
-#  Add on the pixel offsets, and convert to SKY coords, in radians.
+#  Get the pixel coords at the centre of the total intensity map. The
+#  bounds are read in-process if possible.
+         (lbnd,ubnd) = PixelBounds( imap2d )
+         cenx = 0.5*( lbnd[ 0 ] + ubnd[ 0 ] )
+         ceny = 0.5*( lbnd[ 1 ] + ubnd[ 1 ] )
+
+#  Add on the pixel offsets. Convert the central and offset positions to
+#  SKY coords, in radians, and find the arc-distances between them parallel
+#  to the longitude and latitude axes. Do this in-process using pyast if
+#  it is available.
          offx = cenx + dx
          offy = ceny + dy
-         (offa,offb) = invoke("$ATOOLS_DIR/asttran2 this={0} forward=yes "
-                              "xin={1} yin={2}".format( imap2d,offx,offy)).split()
-         offa = float( offa )
-         offb = float( offb )
+         skydist = SkyDistances( imap2d, cenx, ceny, offx, offy )
+         if skydist is not None:
+            ( cena, cenb, offa, offb, dx, dy ) = skydist
 
-#   Now find the arc-distance parallel to the longitude axis, between the central
-#   and offset positions, and convert from radians to arc-seconds.
-         dx = invoke("$ATOOLS_DIR/astdistance this={0}, point1=\[{1},{2}\] "
-                     "point2=\[{3},{4}\]".format(imap2d,cena,cenb,offa,cenb))
-         dx = 3600.0*math.degrees( float( dx ) )
+#  Otherwise, use ATOOLS. Convert the central position to SKY coords, in
+#  radians.
+         else:
+            (cena,cenb) = invoke("$ATOOLS_DIR/asttran2 this={0} forward=yes "
+                                 "xin={1} yin={2}".format( imap2d,cenx,ceny)).split()
+            cena = float( cena )
+            cenb = float( cenb )
+
+#  Convert the offset position to SKY coords, in radians.
+            (offa,offb) = invoke("$ATOOLS_DIR/asttran2 this={0} forward=yes "
+                                 "xin={1} yin={2}".format( imap2d,offx,offy)).split()
+            offa = float( offa )
+            offb = float( offb )
+
+#  Now find the arc-distances parallel to the longitude and latitude axes,
+#  between the central and offset positions.
+            dx = float( invoke("$ATOOLS_DIR/astdistance this={0}, point1=\[{1},{2}\] "
+                        "point2=\[{3},{4}\]".format(imap2d,cena,cenb,offa,cenb)) )
+            dy = float( invoke("$ATOOLS_DIR/astdistance this={0}, point1=\[{1},{2}\] "
+                        "point2=\[{3},{4}\]".format(imap2d,cena,cenb,cena,offb)) )
+
+#  Convert the distances from radians to arc-seconds.
+         dx = 3600.0*math.degrees( dx )
+         dy = 3600.0*math.degrees( dy )
 
 #  The value returned by astDistance is always positive. Adjust the sign
-#  of dx so that it goes the right way.
-         da = offa - cena
-         while da > math.pi:
-            da -= math.pi
-         while da < -math.pi:
-            da += math.pi
+#  of dx so that it goes the right way. The longitude difference is first
+#  normalised into the range -pi to +pi.
+         da = math.remainder( offa - cena, 2*math.pi )
          if da < 0.0:
             dx = -dx
 
-#  Now find the arc-distance parallel to the latitude axis, between the central
-#  and offset positions, and convert from radians to arc-seconds.
-         dy = invoke("$ATOOLS_DIR/astdistance this={0}, point1=\[{1},{2}\] "
-                           "point2=\[{3},{4}\]".format(imap2d,cena,cenb,cena,offb))
-         dy = 3600.0*math.degrees( float( dy ) )
-
 #  The value returned by astDistance is always positive. Adjust the sign
 #  of dx so that it goes the right way.
          db = offb - cenb
@@ -1428,25 +2347,16 @@ def StoreCorrections( qui_maps, imap ):
             dy = -dy
          msg_out( "       {0}: ({1:5.1f},{2:5.1f}) arc-sec".format(key,dx,dy) )
 
-#  Store the required pointing corrections as FITS headers within the map.
-         sym = invoke("$KAPPA_DIR/wcsattrib ndf={0} mode=get name='Symbol(1)'".
-                            format(qui_maps[key]))
-         com = comment.format(sym)
-         invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=PNTRQ_DX "
-                "edit=a value={1} comment=\"'{2}'\""
-                " position=! mode=interface".format(qui_maps[key],dx,com))
-
-         sym = invoke("$KAPPA_DIR/wcsattrib ndf={0} mode=get name='Symbol(2)'".
-                format(qui_maps[key]))
-         com = comment.format(sym)
-         invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=PNTRQ_DY edit=a value={1} "
-                "comment=\"'{2}'\" position=! mode=interface".
-                format(qui_maps[key],dy,com))
-
-#  Also store the scale factor.
-      invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=CHUNKFAC edit=a value={1} "
-             "comment=\"'{2}'\" position=! mode=interface".
-             format(qui_maps[key],scale,scomment))
+#  Note the required pointing corrections, to be stored as FITS headers
+#  within the map.
+         syms = AxisSymbols( qui_maps[key] )
+         headers.append( ( "PNTRQ_DX", dx, comment.format(syms[ 0 ]) ) )
+         headers.append( ( "PNTRQ_DY", dy, comment.format(syms[ 1 ]) ) )
+
+#  Also store the scale factor. All the headers are written to the map
+#  in a single edit of its FITS extension.
+      headers.append( ( "CHUNKFAC", scale, scomment ) )
+      set_fits_headers( qui_maps[key], headers )
 
 #  Find the median of the weights.
    wmed = median( weights.values() )
@@ -1487,140 +2397,141 @@ try:
 #  user is prompted for a value if necessary. The parameters "MSG_FILTER",
 #  "ILEVEL", "GLEVEL" and "LOGFILE" are added automatically by the ParSys
 #  constructor.
-   params = []
-
-
+   params = [
+      starutil.ParNDG("IN", "The input POL2 data",
+                      get_task_par("DATA_ARRAY","GLOBAL",
+                                   default=Parameter.UNSET)),
 
-   params.append(starutil.ParNDG("IN", "The input POL2 data",
-                                 get_task_par("DATA_ARRAY","GLOBAL",
-                                              default=Parameter.UNSET)))
+      starutil.ParNDG("IOUT", "The output total intensity map",
+                      default=None, exists=False, minsize=0,
+                      maxsize=1 ),
 
-   params.append(starutil.ParNDG("IOUT", "The output total intensity map",
-                                 default=None, exists=False, minsize=0,
-                                 maxsize=1 ))
+      starutil.ParNDG("QOUT", "The output Q map",
+                      default=None, exists=False, minsize=0,
+                      maxsize=1 ),
 
-   params.append(starutil.ParNDG("QOUT", "The output Q map",
-                                 default=None, exists=False, minsize=0,
-                                 maxsize=1 ))
+      starutil.ParNDG("UOUT", "The output U map",
+                      default=None, exists=False, minsize=0,
+                      maxsize=1 ),
 
-   params.append(starutil.ParNDG("UOUT", "The output U map",
-                                 default=None, exists=False, minsize=0,
-                                 maxsize=1 ))
+      starutil.Par0S("CAT", "The output FITS vector catalogue",
+                      default=None, noprompt=True),
 
-   params.append(starutil.Par0S("CAT", "The output FITS vector catalogue",
-                                 default=None, noprompt=True))
+      starutil.ParGrp("CONFIG", "Map-maker tuning parameters",
+                      "def", noprompt=True),
 
-   params.append(starutil.ParGrp("CONFIG", "Map-maker tuning parameters",
-                                 "def", noprompt=True))
+      starutil.Par0F("PIXSIZE", "Pixel size (arcsec)", 4.0,
+                      maxval=1000, minval=0.01, noprompt=True),
 
-   params.append(starutil.Par0F("PIXSIZE", "Pixel size (arcsec)", 4.0,
-                                 maxval=1000, minval=0.01, noprompt=True))
+      starutil.Par0S("QUDIR", "Directory in which to save new "
+                     "Q, U and I time series", None, noprompt=True),
 
-   params.append(starutil.Par0S("QUDIR", "Directory in which to save new "
-                                "Q, U and I time series", None, noprompt=True))
+      starutil.Par0S("MAPDIR", "Directory in which to save new "
+                     "I maps before they are co-added", None,
+                     noprompt=True),
 
-   params.append(starutil.Par0S("MAPDIR", "Directory in which to save new "
-                                "I maps before they are co-added", None,
-                                noprompt=True))
+      starutil.Par0S("MASK", "Type of masking to use in makemap",
+                     "AUTO", noprompt=True ),
 
-   params.append(starutil.Par0S("MASK", "Type of masking to use in makemap",
-                                "AUTO", noprompt=True ))
+      starutil.ParChoice("MASKTYPE", ("SIGNAL","MASK"),
+                         "Type of map supplied for parameter MASK",
+                         "SIGNAL", noprompt=True ),
 
-   params.append(starutil.ParChoice("MASKTYPE", ("SIGNAL","MASK"),
-                                    "Type of map supplied for parameter MASK",
-                                    "SIGNAL", noprompt=True ))
+      starutil.Par0L("IPCOR", "Perform IP correction?", None,
+                      noprompt=True),
 
-   params.append(starutil.Par0L("IPCOR", "Perform IP correction?", None,
-                                 noprompt=True))
+      starutil.ParNDG("IPREF", "The total intensity map to use "
+                      "for IP correction", default=None, exists=True,
+                      noprompt=True, minsize=0, maxsize=1 ),
 
-   params.append(starutil.ParNDG("IPREF", "The total intensity map to use "
-                                 "for IP correction", default=None, exists=True,
-                                 noprompt=True, minsize=0, maxsize=1 ))
+      starutil.Par0L("REUSE", "Re-use existing time-streams and maps?", True,
+                      noprompt=True),
 
-   params.append(starutil.Par0L("REUSE", "Re-use existing time-streams and maps?", True,
-                                 noprompt=True))
+      starutil.ParNDG("REF", "Reference map defining the pixel grid", default=None,
+                      noprompt=True, minsize=0, maxsize=1 ),
 
-   params.append(starutil.ParNDG("REF", "Reference map defining the pixel grid", default=None,
-                                 noprompt=True, minsize=0, maxsize=1 ))
+      starutil.ParChoice( "NORTH", ("TRACKING","FK5","ICRS","AZEL",
+                          "GALACTIC","GAPPT","FK4","FK4-NO-E",
+                          "ECLIPTIC"), "Celestial system to "
+                          "use as reference direction", "TRACKING",
+                          noprompt=True ),
 
-   params.append(starutil.ParChoice( "NORTH", ("TRACKING","FK5","ICRS","AZEL",
-                                     "GALACTIC","GAPPT","FK4","FK4-NO-E",
-                                     "ECLIPTIC"), "Celestial system to "
-                                     "use as reference direction", "TRACKING",
-                                     noprompt=True ))
+      starutil.Par0L("DEBIAS", "Remove statistical bias from P"
+                     "and PI?", False, noprompt=True),
 
-   params.append(starutil.Par0L("DEBIAS", "Remove statistical bias from P"
-                                "and PI?", False, noprompt=True))
+      starutil.ParChoice("DEBIASTYPE", ("AS","MAS"),
+                         "Bias estimator to be used",
+                         "AS", noprompt=True ),
 
-   params.append(starutil.ParChoice("DEBIASTYPE", ("AS","MAS"),
-                                    "Bias estimator to be used",
-                                    "AS", noprompt=True ))
+      starutil.Par0L("RETAIN", "Retain temporary files?", False,
+                      noprompt=True),
 
-   params.append(starutil.Par0L("RETAIN", "Retain temporary files?", False,
-                                 noprompt=True))
+      starutil.ParNDG("MASKOUT1", "The output AST mask",
+                      default=None, exists=False, minsize=0,
+                      maxsize=1, noprompt=True ),
 
-   params.append(starutil.ParNDG("MASKOUT1", "The output AST mask",
-                                 default=None, exists=False, minsize=0,
-                                 maxsize=1, noprompt=True ))
+      starutil.ParNDG("MASKOUT2", "The output PCA mask",
+                      default=None, exists=False, minsize=0,
+                      maxsize=1, noprompt=True ),
 
-   params.append(starutil.ParNDG("MASKOUT2", "The output PCA mask",
-                                 default=None, exists=False, minsize=0,
-                                 maxsize=1, noprompt=True ))
+      starutil.Par0S("NEWMAPS", "Text file to hold list of new map",
+                      default=None, noprompt=True),
 
-   params.append(starutil.Par0S("NEWMAPS", "Text file to hold list of new map",
-                                 default=None, noprompt=True))
+      starutil.Par0L("MAPVAR", "Use variance between observation maps?",
+                      False, noprompt=True),
 
-   params.append(starutil.Par0L("MAPVAR", "Use variance between observation maps?",
-                                 False, noprompt=True))
+      starutil.Par0L("MULTIOBJECT", "Allow processing of data from multiple objects?",
+                      False, noprompt=True),
 
-   params.append(starutil.Par0L("MULTIOBJECT", "Allow processing of data from multiple objects?",
-                                 False, noprompt=True))
+      starutil.Par0L("JY", "Should outputs be converted from pW to mJy/beam?",
+                     True, noprompt=True),
 
-   params.append(starutil.Par0L("JY", "Should outputs be converted from pW to mJy/beam?",
-                                True, noprompt=True))
+      starutil.Par0F("FCF", "pW to Jy/beam conversion factor",
+                     None, noprompt=True ),
 
-   params.append(starutil.Par0F("FCF", "pW to Jy/beam conversion factor",
-                                None, noprompt=True ))
+      starutil.ParGrp("ICONFIG", "Map-maker tuning parameters for I maps",
+                      "def", noprompt=True),
 
-   params.append(starutil.ParGrp("ICONFIG", "Map-maker tuning parameters for I maps",
-                                 "def", noprompt=True))
+      starutil.ParGrp("QUCONFIG", "Map-maker tuning parameters for Q/U maps",
+                      "def", noprompt=True),
 
-   params.append(starutil.ParGrp("QUCONFIG", "Map-maker tuning parameters for Q/U maps",
-                                 "def", noprompt=True))
+      starutil.Par0F("BINSIZE", "Catalogue bin size (arcsec)", None,
+                      maxval=1000, minval=0.01, noprompt=True),
 
-   params.append(starutil.Par0F("BINSIZE", "Catalogue bin size (arcsec)", None,
-                                 maxval=1000, minval=0.01, noprompt=True))
+      starutil.Par0L("SKYLOOP", "Use skyloop instead of makemap?",
+                     False, noprompt=True),
 
-   params.append(starutil.Par0L("SKYLOOP", "Use skyloop instead of makemap?",
-                                False, noprompt=True))
+      starutil.Par0L("OBSWEIGHT", "Down-weight unusual observations?",
+                     False, noprompt=True),
 
-   params.append(starutil.Par0L("OBSWEIGHT", "Down-weight unusual observations?",
-                                False, noprompt=True))
+      starutil.Par0L("NORMALISE", "Normalise each observation to the mean?",
+                     False, noprompt=True),
 
-   params.append(starutil.Par0L("NORMALISE", "Normalise each observation to the mean?",
-                                False, noprompt=True))
+      starutil.Par0F("WEIGHTLIM", "Lowest usable observation weight",
+                      0.05, maxval=1.0, minval=0.0, noprompt=True),
 
-   params.append(starutil.Par0F("WEIGHTLIM", "Lowest usable observation weight",
-                                 0.05, maxval=1.0, minval=0.0, noprompt=True))
+      starutil.Par0F("TRIM", "Fractional exposure time at "
+                     "which to trim coadds", None, maxval=10.0,
+                     minval=0.0, noprompt=True),
 
-   params.append(starutil.Par0F("TRIM", "Fractional exposure time at "
-                                "which to trim coadds", None, maxval=10.0,
-                                minval=0.0, noprompt=True))
+      starutil.Par0L("SMOOTH450", "Smooth 450 maps to 850 um resolution?",
+                     False, noprompt=True),
 
-   params.append(starutil.Par0L("SMOOTH450", "Smooth 450 maps to 850 um resolution?",
-                                False, noprompt=True))
+      starutil.ParGrp("CALCQUCONFIG", "CALCQU tuning parameters",
+                      "def", noprompt=True),
 
-   params.append(starutil.ParGrp("CALCQUCONFIG", "CALCQU tuning parameters",
-                                 "def", noprompt=True))
+      starutil.ParNDG( "INITSKYI", "The initial I map", default=None,
+                       minsize=0, maxsize=1, noprompt=True ),
 
-   params.append(starutil.ParNDG( "INITSKYI", "The initial I map", default=None,
-                                  minsize=0, maxsize=1, noprompt=True ))
+      starutil.ParNDG( "INITSKYQ", "The initial Q map", default=None,
+                       minsize=0, maxsize=1, noprompt=True ),
 
-   params.append(starutil.ParNDG( "INITSKYQ", "The initial Q map", default=None,
-                                  minsize=0, maxsize=1, noprompt=True ))
+      starutil.ParNDG( "INITSKYU", "The initial U map", default=None,
+                       minsize=0, maxsize=1, noprompt=True ),
 
-   params.append(starutil.ParNDG( "INITSKYU", "The initial U map", default=None,
-                                  minsize=0, maxsize=1, noprompt=True ))
+      starutil.Par0I("NPROCS", "Maximum number of concurrent processes",
+                     1, minval=1, noprompt=True),
+   ]
 
 #  Initialise the parameters to hold any values supplied on the command
 #  line.
@@ -1729,15 +2640,14 @@ try:
       param = "INITSKY"+qui
       initskys[qui] = parsys[param].value
       if initskys[qui]:
-         invoke("$KAPPA_DIR/ndftrace ndf={0} quiet=yes".format(initskys[qui]) )
+
+         CheckNDF( param, initskys[qui], pixsize, "pW" )
          if first:
             first = False
             ref = initskys[qui]
-            lx = starutil.get_task_par( "lbound(1)", "ndftrace" )
-            ly = starutil.get_task_par( "lbound(2)", "ndftrace" )
-            ux = starutil.get_task_par( "ubound(1)", "ndftrace" )
-            uy = starutil.get_task_par( "ubound(2)", "ndftrace" )
-         CheckNDF( param, initskys[qui], pixsize, "pW" )
+            (lbnd,ubnd) = PixelBounds( ref )
+            (lx,ly) = lbnd[ : 2 ]
+            (ux,uy) = ubnd[ : 2 ]
 
 #  If no initial sky maps were supplied, get the reference map
    if ref is None:
@@ -1751,7 +2661,9 @@ try:
 
 #  Remove any third (wavelength) axis from the reference map. For
 #  instance, this allows 450 um data to be aligned with a map made
-#  from 850 um data.
+#  from 850 um data. All components are copied since, if no IPREF map is
+#  supplied, the trimmed map may also be used as the total intensity map
+#  for the output catalogue, which needs its Variance array.
       if ref != "!":
          ref2d = NDG( 1 )
          invoke( "$KAPPA_DIR/ndfcopy in={0} out={1} trim=yes".
@@ -1781,6 +2693,9 @@ try:
 #  See if we should use skyloop instead of makemap.
    skyloop = parsys["SKYLOOP"].value
 
+#  Get the maximum number of calcqu or makemap processes to run concurrently.
+   nprocs = parsys["NPROCS"].value
+
 #  See if unusual observations should be down-weighted.
    obsweight = parsys["OBSWEIGHT"].value
 
@@ -1878,16 +2793,16 @@ try:
    mapdir =  parsys["MAPDIR"].value
    if not mapdir:
       mapdir = NDG.tempdir
-   elif not os.path.exists(mapdir):
-      os.makedirs(mapdir)
+   else:
+      os.makedirs(mapdir, exist_ok=True)
 
 #  See where to put new Q, U and I time series, and ensure the directory
 #  exists.
    qudir =  parsys["QUDIR"].value
    if not qudir:
       qudir = NDG.tempdir
-   elif not os.path.exists(qudir):
-      os.makedirs(qudir)
+   else:
+      os.makedirs(qudir, exist_ok=True)
 
 #  Get the reference direction.
    north = parsys["NORTH"].value
@@ -1969,25 +2884,17 @@ try:
 
    if get_task_par( "MAPFOUND", "pol2check" ):
 
-      with open(inmaps) as infile:
-         lines = infile.readlines()
-      paths = [line.strip() for line in lines]
-
-      with open(mapinfo) as infile:
-         lines = infile.readlines()
-      infos = [line.strip() for line in lines]
-
-      for (path,info) in zip( paths, infos ):
-         (stokes,id) = info.split()
-         if stokes == "I":
-            imaps[id] = path
-         elif stokes == "Q":
-            qmaps[id] = path
-         else:
-            umaps[id] = path
-
-         inmap = NDG(path)
-         inbeam = get_fits_header( inmap, "INBEAM" )
+#  Check that all the supplied maps can be accessed, using a single NDG
+#  for the whole list. The NDG constructor is called for this check only
+#  (it raises a NoNdfError if any map cannot be accessed), so the returned
+#  object is not used. Each map is then checked in-process if possible.
+      NDG( "^{0}".format(inmaps) )
+      stokes_maps = { "I": imaps, "Q": qmaps }
+      for (path,stokes,id) in ReadListing( inmaps, mapinfo ):
+         stokes_maps.get( stokes, umaps )[ id ] = path
+
+         inmap = path
+         inbeam = get_fits_headers( inmap ).get( "INBEAM" )
          if not inbeam or ("pol" not in inbeam):
             raise starutil.InvalidParameterError("One of the {0} maps ({1}) "
                                           "was not created from POL2 data or "
@@ -2006,120 +2913,100 @@ try:
 
 #  Get a dict in which each key is an observation identifier of the form
 #  <UT>_<OBS>, and each value is a list of raw data files for the observation.
-      with open(inraws) as infile:
-         lines = infile.readlines()
-      paths = [line.strip() for line in lines]
-
-      with open(rawinfo) as infile:
-         lines = infile.readlines()
-      infos = [line.strip() for line in lines]
-
+#  A set of (id,path) tuples is used to detect duplicated paths without
+#  searching the list for each observation.
       rawlist = {}
-      for (path,id) in zip( paths, infos ):
-         if id in rawlist:
-            if path not in rawlist[id]:
-               rawlist[id].append( path )
-         else:
-            rawlist[id] = [ path ]
-
-#  Run calcqu separately on each observation.
+      seen = set()
+      for (path,id) in ReadListing( inraws, rawinfo ):
+         if (id,path) not in seen:
+            seen.add( (id,path) )
+            rawlist.setdefault( id, [] ).append( path )
+
+#  If pre-existing time-streams are to be re-used, scan the QUDIR directory
+#  once to find the time-stream files for all observations.
+      if reuse:
+         oldstreams = ListTimeStreams( qudir, filter )
+
+#  Run calcqu separately on each observation. Each observation is
+#  independent, so if NPROCS is more than one, up to "nprocs" calcqu
+#  processes are run at the same time in background threads, while the
+#  checks for re-usable time-streams for later observations proceed in
+#  this thread. No more than "nprocs+1" observations are left waiting to
+#  be completed at any one time, to avoid getting too far ahead. Each
+#  background calcqu process uses its own ADAM_USER directory so that
+#  concurrent processes do not interfere with each other or with atasks
+#  run by this thread. If NPROCS is one, calcqu is run in this thread so
+#  that its output is displayed as it is produced.
       nobs = len(rawlist)
       iobs = 0
-      for id in rawlist:
-         iobs += 1
+      pending = []
+      with concurrent.futures.ThreadPoolExecutor( max_workers=nprocs ) as pool:
+         for id in rawlist:
+            iobs += 1
 
 #  Create an NDG object holding the raw POL2 files for the current
 #  observation.
-         rawdata = NDG( rawlist[ id ] )
+            rawdata = NDG( rawlist[ id ] )
 
 #  Use CALCQU to create the new Q, U and I time streams from the supplied
 #  analysed intensity time streams. Put them in the QUDIR directory.
-         new_q = NDG.tempfile()
-         new_u = NDG.tempfile()
-         new_i = NDG.tempfile()
-         try:
+            new_q = NDG.tempfile()
+            new_u = NDG.tempfile()
+            new_i = NDG.tempfile()
+            future = None
 
 #  If REUSE is TRUE and old Q, U and I time-streams exists, re-use them.
             try:
                if reuse:
-                  w = filter // 100
-                  aqts = NDG("{0}/s{2}a{1}\*_QT".format(qudir,id,w), True)
-                  auts = NDG("{0}/s{2}a{1}\*_UT".format(qudir,id,w), True)
-                  aits = NDG("{0}/s{2}a{1}\*_IT".format(qudir,id,w), True)
-                  anq = len( aqts )
-                  anu = len( auts )
-                  ani = len( aits )
-                  if anq != anu or anq != ani:
-                     raise starutil.NoNdfError("Ignoring pre-existing data")
-
-                  bqts = NDG("{0}/s{2}b{1}\*_QT".format(qudir,id,w), True)
-                  buts = NDG("{0}/s{2}b{1}\*_UT".format(qudir,id,w), True)
-                  bits = NDG("{0}/s{2}b{1}\*_IT".format(qudir,id,w), True)
-                  bnq = len( bqts )
-                  bnu = len( buts )
-                  bni = len( bits )
-                  if bnq != anq or bnu != anu or bni != ani:
-                     raise starutil.NoNdfError("Ignoring pre-existing data")
-
-                  cqts = NDG("{0}/s{2}c{1}\*_QT".format(qudir,id,w), True)
-                  cuts = NDG("{0}/s{2}c{1}\*_UT".format(qudir,id,w), True)
-                  cits = NDG("{0}/s{2}c{1}\*_IT".format(qudir,id,w), True)
-                  cnq = len( cqts )
-                  cnu = len( cuts )
-                  cni = len( cits )
-                  if cnq != anq or cnu != anu or cni != ani:
-                     raise starutil.NoNdfError("Ignoring pre-existing data")
 
-                  dqts = NDG("{0}/s{2}d{1}\*_QT".format(qudir,id,w), True)
-                  duts = NDG("{0}/s{2}d{1}\*_UT".format(qudir,id,w), True)
-                  dits = NDG("{0}/s{2}d{1}\*_IT".format(qudir,id,w), True)
-                  dnq = len( dqts )
-                  dnu = len( duts )
-                  dni = len( dits )
-                  if dnq != anq or dnu != anu or dni != ani:
+#  Every subarray must have the same non-zero number of Q, U and I
+#  time-stream files for the observation.
+                  counts = set( len( oldstreams.get( (id,a,st), [] ) )
+                                for a in "abcd" for st in ("QT","UT","IT") )
+                  if len( counts ) != 1 or 0 in counts:
                      raise starutil.NoNdfError("Ignoring pre-existing data")
 
                   msg_out("   Re-using previously created Q, U and I "
                           "time-streams for observation {0}".format(id))
 
-                  with open(new_q, "w") as outfile:
-                     for ndg in (aqts,bqts,cqts,dqts):
-                        for ndf in ndg:
-                           outfile.write(ndf+"\n")
-
-                  with open(new_u, "w") as outfile:
-                     for ndg in (auts,buts,cuts,duts):
-                        for ndf in ndg:
-                           outfile.write(ndf+"\n")
-
-                  with open(new_i, "w") as outfile:
-                     for ndg in (aits,bits,cits,dits):
-                        for ndf in ndg:
-                           outfile.write(ndf+"\n")
+                  for (st,fname) in (("QT",new_q),("UT",new_u),("IT",new_i)):
+                     with open(fname, "w") as outfile:
+                        for a in "abcd":
+                           for ndf in oldstreams[ (id,a,st) ]:
+                              outfile.write(ndf+"\n")
 
                else:
                   raise starutil.NoNdfError("Ignoring any pre-existing data")
 
-#  Otherwise create new time-streams.
+#  Otherwise create new time-streams, in a background thread if calcqu
+#  processes are being run concurrently.
             except starutil.NoNdfError:
                msg_out("   {0}/{1}: Processing {2} raw data files from observation {3} ... ".
                        format(iobs,nobs,len(rawlist[ id ]), id ) )
-               invoke("$SMURF_DIR/calcqu in={0} lsqfit=yes config={6} outq={1}/\*_QT "
-                      "outu={1}/\*_UT outi={1}/\*_IT fix=yes north={2} outfilesi={3} "
-                      "outfilesq={4} outfilesu={5}".
-                      format( rawdata, qudir, north, new_i, new_q, new_u, calcquconfig ) )
+               cmd = ( "$SMURF_DIR/calcqu in={0} lsqfit=yes config={6} outq={1}/\*_QT "
+                       "outu={1}/\*_UT outi={1}/\*_IT fix=yes north={2} outfilesi={3} "
+                       "outfilesq={4} outfilesu={5}".
+                       format( rawdata, qudir, north, new_i, new_q, new_u, calcquconfig ) )
+               if nprocs > 1:
+                  future = pool.submit( invoke, cmd, buffer=True,
+                                        env={ "ADAM_USER": NDG.subdir() } )
+               else:
+                  try:
+                     invoke( cmd )
+                  except starutil.AtaskError as err:
+                     CalcquFailed( id, err )
+                     continue
 
 #  Append the new Stokes parameter time series files created above to the
-#  list of all Stokes parameter time series files.
-            with open(allquis, 'a') as outfile:
-               for fname in ( new_q, new_u, new_i ):
-                   if os.path.isfile( fname ):
-                       with open(fname) as infile:
-                          outfile.write(infile.read())
+#  list of all Stokes parameter time series files. This is done in the
+#  original observation order, waiting for calcqu if necessary.
+            pending.append( (id,future,new_q,new_u,new_i) )
+            while len( pending ) > nprocs + 1 or ( pending and ( pending[0][1] is None or
+                                                        pending[0][1].done() ) ):
+               FinishCalcqu( pending.pop( 0 ), allquis )
 
-         except starutil.AtaskError as err:
-            msg_out( err )
-            msg_out( "\nAn error occurred within CALCQU. The above observation will be ignored.\nContinuing to process any remaining observations...\n" )
+         while pending:
+            FinishCalcqu( pending.pop( 0 ), allquis )
 
 
 
@@ -2159,37 +3046,14 @@ try:
 
 #  Set up three dicts - one each for Q, U and I. Each key is as described
 #  above. Each value is a list of paths for NDFs holding data with the same
-#  key and the same Stokes parameter (Q, U or I).
-      with open(allquis) as infile:
-         lines = infile.readlines()
-      paths = [line.strip() for line in lines]
-
-      with open(stokesinfo) as infile:
-         lines = infile.readlines()
-      infos = [line.strip() for line in lines]
-
-      for (path,info) in zip( paths, infos ):
-         (stokes,id) = info.split()
-         if stokes == "Q":
-            if id in qlist:
-               if path not in qlist[id]:
-                  qlist[id].append( path )
-            else:
-               qlist[id] = [ path ]
-
-         elif stokes == "U":
-            if id in ulist:
-               if path not in ulist[id]:
-                  ulist[id].append( path )
-            else:
-               ulist[id] = [ path ]
-
-         else:
-            if id in ilist:
-               if path not in ilist[id]:
-                  ilist[id].append( path )
-            else:
-               ilist[id] = [ path ]
+#  key and the same Stokes parameter (Q, U or I). A set of (stokes,id,path)
+#  tuples is used to detect duplicated paths without searching the lists.
+      seen = set()
+      stokes_lists = { "Q": qlist, "U": ulist }
+      for (path,stokes,id) in ReadListing( allquis, stokesinfo ):
+         if (stokes,id,path) not in seen:
+            seen.add( (stokes,id,path) )
+            stokes_lists.get( stokes, ilist ).setdefault( id, [] ).append( path )
 
 #  If required, generate the AST and PCA masks from the supplied MASK
 #  map.
@@ -2201,29 +3065,10 @@ try:
 
 #  Get the SNR thresholds for the AST and PCA masks from the supplied config
 #  file, using defaults if they are not there.
-         try:
-            ast_snr = float( invoke("$KAPPA_DIR/configecho name=ast.zero_snr "
-                                    "config={0}".format(config)) )
-         except Exception:
-            ast_snr = 3.0
-
-         try:
-            ast_snrlo = float( invoke("$KAPPA_DIR/configecho name=ast.zero_snrlo "
-                                    "config={0}".format(config)) )
-         except Exception:
-            ast_snrlo = 2.0
-
-         try:
-            pca_snr = float( invoke("$KAPPA_DIR/configecho name=pca.zero_snr "
-                                    "config={0}".format(config)) )
-         except Exception:
-            pca_snr = 3.0
-
-         try:
-            pca_snrlo = float( invoke("$KAPPA_DIR/configecho name=pca.zero_snrlo "
-                                    "config={0}".format(config)) )
-         except Exception:
-            pca_snrlo = 2.0
+         ast_snr = ConfigFloat( config, "ast.zero_snr", 3.0 )
+         ast_snrlo = ConfigFloat( config, "ast.zero_snrlo", 2.0 )
+         pca_snr = ConfigFloat( config, "pca.zero_snr", 3.0 )
+         pca_snrlo = ConfigFloat( config, "pca.zero_snrlo", 2.0 )
 
 #  Very strong sources such as Orion A can create masks in which there
 #  are insufficient background pixels to allow future invocations of
@@ -2231,42 +3076,35 @@ try:
 #  the mask until no more than 20% of the originally good pixels are
 #  designated as source pixels. The AST mask contains peaks above SNR=3,
 #  followed down to SNR=2.
-         invoke("$KAPPA_DIR/stats ndf={0}".format(snr))
-         ngood = float( get_task_par( "numgood", "stats" ) )
+         ngood = NumGood( snr )
+         snrgood = ngood
          maxgood = ngood / 5
 
          noise = ast_snrlo
          minheight = ast_snr
-         aconf = NDG.tempfile()
-
-         while True:
-            fd = open(aconf,"w")
-            fd.write("FellWalker.FlatSlope=0\n")
-            fd.write("FellWalker.MinDip=1.0E30\n")
-            fd.write("FellWalker.Noise={0}\n".format(noise))
-            fd.write("FellWalker.MinHeight={0}\n".format(minheight))
-            fd.close()
-            invoke("$CUPID_DIR/findclumps in={0} method=fellwalker rms=1 "
-                   "outcat=! out={1} config=^{2}".format(snr,astmask,aconf))
 
-            try:
-               invoke("$KAPPA_DIR/stats ndf={0}".format(astmask))
-               ngood = float( get_task_par( "numgood", "stats" ) )
-               if ngood < 5:
-                  raise starutil.InvalidParameterError( "No significant emission "
-                               "found in total intensity map {0} supplied for "
-                               "parameter MASK".format(maskmap))
-            except starutil.AtaskError:
+#  Write a config file holding the FellWalker parameters that are the same
+#  for every invocation of findclumps. The Noise and MinHeight values are
+#  appended on the command line.
+         fwconf = NDG.tempfile()
+         WriteConfig( fwconf, "FellWalker.FlatSlope=0\n"
+                              "FellWalker.MinDip=1.0E30\n" )
+
+#  If possible, skip the steps that would certainly produce too many
+#  source pixels, using an in-memory estimate of the findclumps result.
+#  FindMask then confirms the estimate using findclumps.
+         steps = EstimateMaskThresholds( snr, noise, minheight, maxgood,
+                                         snrgood )
+         try:
+            ngood = FindMask( snr, astmask, fwconf, steps, maxgood )
+            if ngood < 5:
                raise starutil.InvalidParameterError( "No significant emission "
-                               "found in total intensity map {0} supplied for "
-                               "parameter MASK".format(maskmap))
-
-            if ngood < maxgood:
-               break
-            else:
-               if noise == minheight:
-                  minheight *= 1.2
-               noise = minheight
+                            "found in total intensity map {0} supplied for "
+                            "parameter MASK".format(maskmap))
+         except starutil.AtaskError:
+            raise starutil.InvalidParameterError( "No significant emission "
+                            "found in total intensity map {0} supplied for "
+                            "parameter MASK".format(maskmap))
 
 #  The source regions within the PCA mask need to be smaller than in the
 #  AST mask. Make sure it uses no more than 10% of the original good
@@ -2275,45 +3113,22 @@ try:
 
          noise = pca_snrlo
          minheight = pca_snr
-         pconf = NDG.tempfile()
-
-         while True:
-            fd = open(pconf,"w")
-            fd.write("FellWalker.FlatSlope=0\n")
-            fd.write("FellWalker.MinDip=1.0E30\n")
-            fd.write("FellWalker.Noise={0}\n".format(noise))
-            fd.write("FellWalker.MinHeight={0}\n".format(minheight))
-            fd.close()
-            invoke("$CUPID_DIR/findclumps in={0} method=fellwalker rms=1 "
-                   "outcat=! out={1} config=^{2}".format(snr,pcamask,pconf))
-
-            try:
-               invoke("$KAPPA_DIR/stats ndf={0}".format(pcamask))
-               ngood = float( get_task_par( "numgood", "stats" ) )
-            except starutil.AtaskError:
-               ngood = 0
-               pcamask = None
-               msg_out( "WARNING - No significant emission found in total "
-                        "intensity map {0} supplied for parameter MASK - "
-                        "shall proceed without PCA masking.".format(maskmap))
-               break
-
-            if ngood < maxgood:
-               break
-            else:
-               if noise == minheight:
-                  minheight *= 1.2
-               noise = minheight
+         steps = EstimateMaskThresholds( snr, noise, minheight, maxgood,
+                                         snrgood )
+         try:
+            ngood = FindMask( snr, pcamask, fwconf, steps, maxgood )
+         except starutil.AtaskError:
+            ngood = 0
+            pcamask = None
+            msg_out( "WARNING - No significant emission found in total "
+                     "intensity map {0} supplied for parameter MASK - "
+                     "shall proceed without PCA masking.".format(maskmap))
 
 
 #  We need to decide on the value to use for the PCA.PCATHRESH config
 #  parameter when running makemap below. If a value is given in the
 #  user-supplied config, use it.
-      try:
-         pcathresh = float( invoke("$KAPPA_DIR/configecho name=pca.pcathresh "
-                                   "config={0}".format(config)) )
-      except Exception:
-         pcathresh = 0
+      pcathresh = ConfigFloat( config, "pca.pcathresh", 0 )
 
 #  If no value is supplied in the config, the default values are -50
 #  (pcathresh_def1) for auto-masked maps and -150 (pcathresh_def2) for
@@ -2366,142 +3181,94 @@ try:
 #  to retain pcathresh at zero, so that ABORTSOON is used when running
 #  makemap.
       if pcathresh == 0:
-         try:
-            models = invoke("$KAPPA_DIR/configecho name=modelorder "
-                            "config={0}".format(config))
-            if "<***>" not in models and "pca" not in models.lower():
-               pcathresh = (pcathresh_def1 if automask else pcathresh_def2)
-         except Exception:
-            pass
+         models = ConfigValue( config, "modelorder" )
+         if models is not None and "pca" not in models.lower():
+            pcathresh = (pcathresh_def1 if automask else pcathresh_def2)
 
 #  See if the ICONFIG or QUCONFIG configurations provide a value for
 #  PCA.PCATHRESH, in which case it over-rides the above value.
-      try:
-         pcathresh_i = float( invoke("$KAPPA_DIR/configecho name=pca.pcathresh "
-                                     "config={0}".format(iconfig)) )
-      except Exception:
-         pcathresh_i = pcathresh
-
-      try:
-         pcathresh_qu = float( invoke("$KAPPA_DIR/configecho name=pca.pcathresh "
-                                     "config={0}".format(quconfig)) )
-      except Exception:
-         pcathresh_qu = pcathresh
+      pcathresh_i = ConfigFloat( iconfig, "pca.pcathresh", pcathresh )
+      pcathresh_qu = ConfigFloat( quconfig, "pca.pcathresh", pcathresh )
 
 #  Create a config file to use with makemap. This file contains stuff
-#  that is used when creating both I maps and Q/U maps.
-      fd = open(conf,"w")
-
-#  Store the default set of config parameters in the config file.
-      fd.write("^$STARLINK_DIR/share/smurf/.dimmconfig_pol2.lis\n")
-      fd.write("numiter = -200\n")
-      fd.write("modelorder = (com,gai,pca,ext,flt,ast,noi)\n")
-
-      fd.write("maptol = 0.05\n")
-      fd.write("maptol_mask = <undef>\n")
-      fd.write("maptol_mean = 0\n")
-      fd.write("maptol_box = 60\n")
-      fd.write("maptol_hits = 1\n")
-
-      fd.write("pca.pcathresh = {0}\n".format( pcathresh_def2 if (pcathresh==0) else pcathresh))
-      fd.write("ast.mapspike_freeze = 5\n")
-      fd.write("pca.zero_niter = 0.5\n")
-      fd.write("com.zero_niter = 0.5\n")
-      fd.write("flt.zero_niter = 0.5\n")
-      fd.write("com.freeze_flags = 30\n")
+#  that is used when creating both I maps and Q/U maps. It starts with
+#  the default set of config parameters.
+      text = conf_common
 
 #  Some depend on the masking type.
       if automask:
-         fd.write("ast.skip = 10\n")
-         fd.write("ast.zero_snr = 3\n")
-         fd.write("ast.zero_snrlo = 2\n")
-         fd.write("ast.zero_freeze = 0.2\n")
-
-         fd.write("pca.pcathresh = {0}\n".format( pcathresh_def1 if (pcathresh==0) else pcathresh))
-         fd.write("pca.zero_snr = 5\n")
-         fd.write("pca.zero_snrlo = 3\n")
-         fd.write("pca.zero_freeze = -1\n")
-
-         fd.write("com.zero_snr = 5\n")
-         fd.write("com.zero_snrlo = 3\n")
-         fd.write("com.zero_freeze = -1\n")
-
-         fd.write("flt.zero_snr = 5\n")
-         fd.write("flt.zero_snrlo = 3\n")
-         fd.write("flt.zero_freeze = -1\n")
-
+         text += conf_automask
       elif circlemask:
-         fd.write("ast.zero_circle = (0.0083)\n")
-         fd.write("pca.zero_circle = (0.0083)\n")
-         fd.write("com.zero_circle = (0.0083)\n")
-         fd.write("flt.zero_circle = (0.0083)\n")
-
+         text += conf_circlemask
       else:
-         fd.write("ast.zero_mask = mask2\n")
+         text += conf_extmask
          if pcamask:
             pcamaskpar = "mask3={0}".format(pcamask)
-            fd.write("pca.zero_mask = mask3\n")
-            fd.write("com.zero_mask = mask3\n")
-            fd.write("flt.zero_mask = mask3\n")
+            text += conf_pcamask
+
+#  Add the PCA.PCATHRESH value, using the default for the masking type if
+#  no value has yet been determined.
+      if pcathresh == 0:
+         text += "pca.pcathresh = {0}\n".format( pcathresh_def1 if automask
+                                                 else pcathresh_def2 )
+      else:
+         text += "pca.pcathresh = {0}\n".format( pcathresh )
 
 #  If the user supplied extra config parameters, append them to the
 #  config file. Note, "config" will include any required "^" character and
 #  so the format string below does not need to include an explicit "^"
 #  character.
       if config and config != "def":
-         fd.write("{0}\n".format(config))
+         text += "{0}\n".format(config)
 
-#  Close the basic config file that contains stuff used when creating both
-#  I and Q/U maps.
-      fd.close()
+#  Write out the basic config file that contains stuff used when creating
+#  both I and Q/U maps.
+      WriteConfig( conf, text )
 
 #  We create two derived config files that inherit the above common config:
 #  one for use when creating I maps and one for use when creating Q or U
 #  maps. They may contain different values if the user supplies anything
 #  for ICONFIG or QUCONFIG. First create the I config file.
-      fd = open(iconf,"w")
-
+#
 #  Include the common config created above. Note, "conf" is a simple file
 #  name - not a configuration - and so we need to include the "^" explicitly
 #  in the format string.
-      fd.write("^{0}\n".format(conf))
+      text = "^{0}\n".format(conf)
 
 #  If the user has supplied any I-specific config parameters, include them
 #  now so that they over-ride values in the common config. Note, "iconfig"
 #  is a complete configuration, and so will already include any required "^"
 #  character. So do not include a "^" in the format string.
       if iconfig and iconfig != "def":
-         fd.write("{0}\n".format(iconfig))
+         text += "{0}\n".format(iconfig)
 
 #  Put in values that are absolutely required by this script. These
 #  over-write any values in the user-supplied configs. This includes
 #  resetting mask SNR thresholds so that any SNR limits intended for
 #  use just by findclumps are not also used by makemap.
-      fd.write("noi.usevar=1\n")
-      fd.write("flagslow=0.01\n")
-      fd.write("downsampscale=0\n")
-
+      text += conf_required
       if maskmap and masktype == "SIGNAL":
-         fd.write("ast.zero_snr=0\n")
-         fd.write("pca.zero_snr=0\n")
-         fd.write("flt.zero_snr=0\n")
-         fd.write("com.zero_snr=0\n")
-      fd.close()
+         text += conf_snrreset
+
+      WriteConfig( iconf, text )
 
 #  Create the QU config file in the same way. For Q and U maps, the
 #  astronomical signal is much weaker and the common mode is much less
 #  well defined. This can cause the COM model to throw out huge amounts
 #  of data. To prevent, this disable common-mode flagging when creating
 #  Q/U maps.
-      fd = open(quconf,"w")
-      fd.write("com.noflag=1\n")
-      fd.write("^{0}\n".format(conf))
+      text = "com.noflag=1\n^{0}\n".format(conf)
       if quconfig and quconfig != "def":
-         fd.write("{0}\n".format(quconfig))
-      fd.write("noi.usevar=1\n")
-      fd.write("flagslow=0.01\n")
-      fd.write("downsampscale=0\n")
-      fd.close()
+         text += "{0}\n".format(quconfig)
+      text += conf_required
+
+      WriteConfig( quconf, text )
+
+#  Any reduced PCA.PCATHRESH value found to be needed because makemap
+#  failed to converge is supplied to all subsequent makemap runs on the
+#  command line, following the config file. This dict holds the extra
+#  config text to use with each config file.
+   pcapars = {}
 
 #  Loop over each Stokes parameter, creating maps from each observation
 #  if reqired.
@@ -2509,7 +3276,9 @@ try:
 
 #  Pass on to the next parameter if we are not creating a map for the
 #  current parameter. Also set up pointers to the arrays etc to use for
-#  the current Stokes parameter.
+#  the current Stokes parameter. The NDF to hold the copy of the coadd
+#  used to create the catalogue is only needed if a catalogue is being
+#  created.
       if qui == 'I':
          if imap:
             qui_maps = imaps
@@ -2517,7 +3286,7 @@ try:
             conf = iconf
             coadd = imap
             pcathresh = pcathresh_i
-            imap_cat = NDG(1)
+            imap_cat = NDG(1) if outcat else None
             coadd_cat = imap_cat
             this_ip = ""
          else:
@@ -2530,7 +3299,7 @@ try:
             conf = quconf
             coadd = qmap
             pcathresh = pcathresh_qu
-            qmap_cat = NDG(1)
+            qmap_cat = NDG(1) if outcat else None
             coadd_cat = qmap_cat
             this_ip = ip
          else:
@@ -2543,7 +3312,7 @@ try:
             conf = quconf
             coadd = umap
             pcathresh = pcathresh_qu
-            umap_cat = NDG(1)
+            umap_cat = NDG(1) if outcat else None
             coadd_cat = umap_cat
             this_ip = ip
          else:
@@ -2610,11 +3379,9 @@ try:
 #  supplied coadd (if it exists) or the reference map (if it exists)
 #  or use the PIXSIZE parameter otherwise.
          if coadd_exists:
-            invoke("$KAPPA_DIR/ndftrace ndf={0} quiet=yes".format(coadd) )
-            pxsize = float(get_task_par( "FPIXSCALE(1)", "ndftrace" ))
+            pxsize = PixelSize( coadd )[ 0 ]
          elif ref != "!":
-            invoke("$KAPPA_DIR/ndftrace ndf={0} quiet=yes".format(ref) )
-            pxsize = float(get_task_par( "FPIXSCALE(1)", "ndftrace" ))
+            pxsize = PixelSize( ref )[ 0 ]
          else:
             pxsize = pixsize
 
@@ -2661,6 +3428,11 @@ try:
 #  Indicate that no new maps have yet been made.
       make_new_maps = False
 
+#  Get the names of all files currently in the map directory. This is
+#  used to check for pre-existing observation maps without needing to
+#  examine each file individually.
+      mapdir_files = ListDir( mapdir )
+
 #  If we are using skyloop to generate the observation maps...
 #  -----------------------------------------------------------
       skyloop_used = False
@@ -2689,9 +3461,9 @@ try:
             if coadd_exists and reuse:
                nexist = 0
                for key in qui_list.keys():
-                  obsmap_path = "{0}/{1}_{2}.sdf".format(mapdir,key,suffix)
-                  if os.path.exists(obsmap_path):
-                     qui_maps[key] = NDG(obsmap_path)
+                  obsmap_name = "{0}_{1}.sdf".format(key,suffix)
+                  if obsmap_name in mapdir_files:
+                     qui_maps[key] = NDG( os.path.join( mapdir, obsmap_name ) )
                      nexist += 1
 
                if nexist > len(qui_list)/2:
@@ -2707,8 +3479,9 @@ try:
             if reuse:
                nbad = 0
                for key in qui_list.keys():
-                  obsmap_path = "{0}/{1}_{2}.sdf".format(mapdir,key,suffix)
-                  if os.path.exists(obsmap_path):
+                  obsmap_name = "{0}_{1}.sdf".format(key,suffix)
+                  if obsmap_name in mapdir_files:
+                     obsmap_path = os.path.join( mapdir, obsmap_name )
                      if nbad == 0:
                         msg_out("\n ")
                      nbad += 1
@@ -2741,23 +3514,20 @@ try:
                   fd.write( path+"\n" )
             fd.close()
 
-#  Create a text file holding the pointing corrections for all input
-#  time-streams. First include any AZ/EL pointing correction, for
+#  Create the text of a file holding the pointing corrections for all
+#  input time-streams. First include any AZ/EL pointing correction, for
 #  data between 20150606 and 20150930, ensuring the correction goes
 #  to zero for later data (skyloop process multiple observations
 #  simultaneously, so old and new observations may be processed together).
+#  The file is written out in one go once all corrections are known.
+            pnttext = ""
             if azelcor:
-               pntfile = NDG.tempfile()
-               fd = open(pntfile,"w")
-               fd.write("# system=azel\n")
-               fd.write("# tai dlon dlat\n")
-               fd.write("57179 32.1 27.4\n")
-               fd.write("57295.5 32.1 27.4\n")
-               fd.write("57295.6 0.0 0.0\n")
-               fd.write("57295.7 0.0 0.0\n")
-               fd.close()
-            else:
-               pntfile = "!"
+               pnttext += ( "# system=azel\n"
+                            "# tai dlon dlat\n"
+                            "57179 32.1 27.4\n"
+                            "57295.5 32.1 27.4\n"
+                            "57295.6 0.0 0.0\n"
+                            "57295.7 0.0 0.0\n" )
 
 #  Create the timeframe and mapping used to convert DATE-OBS values (utc)
 #  to mjd TAI values.
@@ -2780,7 +3550,7 @@ try:
                nnowgt = 0
                for key in qui_list:
                   try:
-                     hmap = NDG("{0}/{1}_imap".format(mapdir,key))
+                     hmap = NDG(os.path.join( mapdir, "{0}_imap".format(key) ))
                      wgt = float( get_fits_header( hmap, "CHUNKWGT", report=True ))
                      nwgt += 1
                   except Exception:
@@ -2802,6 +3572,7 @@ try:
                   invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=CHUNKWGT "
                          "edit=a value={1} comment=\"'Weight for this chunk of data'\""
                          " position=! mode=interface".format(NDG(qui_list[key]),wgt))
+                  forget_fits_headers( qui_list[key] )
 
                if nwgt == 0:
                   raise starutil.InvalidParameterError( "\npol2map was run "
@@ -2859,7 +3630,7 @@ try:
             if normalise:
                for key in qui_list:
                   try:
-                     hmap = NDG("{0}/{1}_imap".format(mapdir,key))
+                     hmap = NDG(os.path.join( mapdir, "{0}_imap".format(key) ))
                      factor = float( get_fits_header( hmap, "CHUNKFAC",
                                                       report=True ))
                   except starutil.NoValueError:
@@ -2879,6 +3650,7 @@ try:
                   invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=CHUNKFAC edit=a "
                          "value={1} comment=\"'Calibration correction factor'\" "
                          "position=! mode=interface".format(NDG(qui_list[key]),factor))
+                  forget_fits_headers( qui_list[key] )
 
 #  If any of the factors are not 1.0, modify the config to indicate that
 #  makemap should read the factors from the CHUNKFAC header in the
@@ -2894,39 +3666,32 @@ try:
 
 #  Add pointing corrections to the file for each observation
             corrections = {}
-            fd = None
             for key in qui_list:
 
 #  If an auto-masked I map from a previous run exists for the current
 #  observation, see if it has pointing corrections recorded in its FITS
 #  header. If so, we use them when creating the new map.
-               try:
-                  hmap = NDG("{0}/{1}_imap".format(mapdir,key))
-                  dx = get_fits_header( hmap, "PNTRQ_DX" )
-                  dy = get_fits_header( hmap, "PNTRQ_DY" )
-               except starutil.NoNdfError:
-                  dx = None
-                  dy = None
+               dx = None
+               dy = None
+               if "{0}_imap.sdf".format(key) in mapdir_files:
+                  try:
+                     hmap = NDG(os.path.join( mapdir, "{0}_imap".format(key) ))
+                     dx = get_fits_header( hmap, "PNTRQ_DX" )
+                     dy = get_fits_header( hmap, "PNTRQ_DY" )
+                  except starutil.NoNdfError:
+                     pass
 
-#  If required, create a file to hold the correction If a file is
-#  already in use (because of the data being old) append the new
-#  pointing correction to the end of the file, preceeded by an
-#  "end-of-table" marker (two minus signs). Makemap will then apply
-#  both correction.
+#  If required, start a table to hold the corrections. If an AZ/EL table
+#  is already in use (because of the data being old) append the new
+#  pointing corrections after it, preceeded by an "end-of-table" marker
+#  (two minus signs). Makemap will then apply both correction.
                if dx is not None and dy is not None:
                   dx = float( dx )
                   dy = float( dy )
-                  if pntfile == "!":
-                     pntfile = NDG.tempfile()
-                     fd = open(pntfile,"w")
-                     fd.write("# system=tracking\n")
-                     fd.write("# tai dlon dlat\n")
-
-                  elif fd is None:
-                     fd = open(pntfile,"a")
-                     fd.write("--\n")
-                     fd.write("# system=tracking\n")
-                     fd.write("# tai dlon dlat\n")
+                  if not corrections:
+                     if pnttext:
+                        pnttext += "--\n"
+                     pnttext += "# system=tracking\n# tai dlon dlat\n"
 
 #  Add two lines to the correction file - the first corresponds to the
 #  earliest data in the current observation and the second corresponds
@@ -2950,11 +3715,16 @@ try:
                   corrections[taiend] = "{0} {1} {2}\n".format(taiend,dx,dy)
 
 #  Ensure the corrections are sorted into monotonic increasing TAI
-#  values, write them out to the file and then close the file.
-            if fd is not None:
-               for tai in sorted(corrections.keys()):
-                  fd.write(corrections[tai])
-               fd.close()
+#  values, and write the complete table out to the file.
+            for tai in sorted(corrections.keys()):
+               pnttext += corrections[tai]
+
+            if pnttext:
+               pntfile = NDG.tempfile()
+               with open(pntfile,"w") as fd:
+                  fd.write( pnttext )
+            else:
+               pntfile = "!"
 
 #  If we will be smoothing the map to the 850 um resolution, we need to
 #  put the original (unsmoothed) coadd in a different NDG object. The final
@@ -3013,7 +3783,7 @@ try:
 #  First chunk for this ut/obs? If so, the corresponding skyloop map name
 #  will include no chunk number.
                if ut != ut_previous or obs != obs_previous:
-                  oldpath = "{0}/{1}_{2}.sdf".format(obsdir,ut,obs)
+                  oldpath = os.path.join( obsdir, "{0}_{1}.sdf".format(ut,obs) )
                   ut_previous = ut
                   obs_previous = obs
                   next_chunk = 1
@@ -3021,11 +3791,11 @@ try:
 #  Subsequent chunks for this ut/obs are assumed to be in the same order
 #  as the subscans number within "key".
                else:
-                  oldpath = "{0}/{1}_{2}_chunk{3}.sdf".format(obsdir,ut,obs,next_chunk)
+                  oldpath = os.path.join( obsdir, "{0}_{1}_chunk{2}.sdf".format(ut,obs,next_chunk) )
                   next_chunk += 1
 
 #  Get the new file name and check the old file exists.
-               newpath = "{0}/{1}_{2}.sdf".format(mapdir,key,suffix)
+               newpath = os.path.join( mapdir, "{0}_{1}.sdf".format(key,suffix) )
                if os.path.exists(oldpath):
 
 #  If so, copy quality information from the coadd created by skyloop to
@@ -3066,14 +3836,24 @@ try:
 #  separate observation will usually have one time series file (although
 #  there may be more if the observation was split into two or more discontiguous
 #  chunks). We form a map for each observation chunk present in the supplied
-#  list of input raw data.
+#  list of input raw data. Maps that can be created concurrently are
+#  recorded in "pending" and are created after this loop.
+         pending = []
+         numiter = None
          for key in qui_list:
 
 #  Get the Stokes time stream files for the current observation chunk.
             isdf = NDG( qui_list[ key ] )
 
+#  Read all the FITS headers from the first time stream file at once. The
+#  UTDATE value obtained below using get_fits_header is then taken from
+#  the header cache.
+            headers = get_fits_headers( isdf[0] )
+
 #  Get the chunk weight. If it is below the minimum, skip this observation.
-            wgt = get_fits_header( isdf[0], "CHUNKWGT" )
+            wgt = headers.get( "CHUNKWGT" )
+            if wgt:
+               wgt = float( wgt )
             if wgt and wgt < wgtlim:
                del qui_maps[key]
                badkeys.append( key )
@@ -3082,83 +3862,87 @@ try:
             else:
                msg_out("\nMaking {1} map from {0}...\n".format(key,qui) )
 
+#  Get the path to the map.
+            mapname = os.path.join( mapdir, "{0}_{1}".format(key,suffix) )
+
+#  If REUSE is True and an old map exists, re-use it. This is checked
+#  before determining any pointing corrections, since they are not needed
+#  for a re-used map. The directory listing is checked first to avoid
+#  running ndfecho for maps that do not exist.
+            if reuse and "{0}_{1}.sdf".format(key,suffix) in mapdir_files:
+               try:
+                  qui_maps[key] = NDG(mapname, True)
+                  msg_out("   Re-using previously created map {0}".format(qui_maps[key]))
+                  new_maps.append( qui_maps[key] )
+                  continue
+               except starutil.NoNdfError:
+                  pass
+
+#  Otherwise create a new map.
+            make_new_maps = True
+
 #  AZ/EL pointing correction, for data between 20150606 and 20150930. Not
 #  using skyloop here, so only one observation will be processed at any one
 #  time, so no danger of having old and new data files together.
-            ut = int(get_fits_header( isdf[0], "UTDATE", True ))
+#  The text of the pointing correction file is written out in one go once
+#  all corrections are known.
+            pnttext = ""
+            ut = int( get_fits_header( isdf[0], "UTDATE", True ) )
             if ut >= 20150606 and ut <= 20150929:
-               pntfile = NDG.tempfile()
-               fd = open(pntfile,"w")
-               fd.write("# system=azel\n")
-               fd.write("# tai dlon dlat\n")
-               fd.write("54000 32.1 27.4\n")
-               fd.write("56000 32.1 27.4\n")
-               fd.close()
-            else:
-               pntfile = "!"
+               pnttext += ( "# system=azel\n"
+                            "# tai dlon dlat\n"
+                            "54000 32.1 27.4\n"
+                            "56000 32.1 27.4\n" )
 
 #  If an auto-masked I map from a previous run exists for the current
 #  observation, see if it has pointing corrections recorded in its FITS
 #  header. If so, we use them when creating the new map.
-            try:
-               hmap = NDG("{0}/{1}_imap".format(mapdir,key))
-               dx = get_fits_header( hmap, "PNTRQ_DX" )
-               dy = get_fits_header( hmap, "PNTRQ_DY" )
-            except starutil.NoNdfError:
-               dx = None
-               dy = None
+            dx = None
+            dy = None
+            if "{0}_imap.sdf".format(key) in mapdir_files:
+               hheaders = get_fits_headers( os.path.join( mapdir, "{0}_imap".format(key) ) )
+               dx = hheaders.get( "PNTRQ_DX" )
+               dy = hheaders.get( "PNTRQ_DY" )
 
 #  Create the pointing correction file to use when running makemap. If
-#  a file is already in use (because of the data being old) append the
-#  new pointing correction to the end of the file, preceeded by an
+#  an AZ/EL correction is already in use (because of the data being old)
+#  append the new pointing correction after it, preceeded by an
 #  "end-of-table" Marker (two minus signs). Makemap will then apply
 #  both correction.
             if dx is not None and dy is not None:
                dx = float( dx )
                dy = float( dy )
-               if pntfile == "!":
-                  pntfile = NDG.tempfile()
-                  fd = open(pntfile,"w")
-               else:
-                  fd = open(pntfile,"a")
-                  fd.write("--\n")
-
-               fd.write("# system=tracking\n")
-               fd.write("# tai dlon dlat\n")
-               fd.write("54000 {0} {1}\n".format(dx,dy))
-               fd.write("56000 {0} {1}\n".format(dx,dy))
-               fd.close()
-
-#  Get the path to the map.
-            mapname = "{0}/{1}_{2}".format(mapdir,key,suffix)
-
-#  If REUSE is True and an old map exists, re-use it.
-            try:
-               if reuse:
-                  qui_maps[key] = NDG(mapname, True)
-                  msg_out("   Re-using previously created map {0}".format(qui_maps[key]))
-               else:
-                  raise starutil.NoNdfError("Ignoring pre-existing data")
-
-#  Otherwise create a new map.  The call signature for makemap depends on
-#  whether an external mask is being supplied or not.
-            except starutil.NoNdfError:
-               make_new_maps = True
+               if pnttext:
+                  pnttext += "--\n"
+               pnttext += ( "# system=tracking\n"
+                            "# tai dlon dlat\n"
+                            "54000 {0} {1}\n"
+                            "56000 {0} {1}\n".format(dx,dy) )
+
+            if pnttext:
+               pntfile = NDG.tempfile()
+               with open(pntfile,"w") as fd:
+                  fd.write( pnttext )
+            else:
+               pntfile = "!"
 
-               if dx is not None and dy is not None:
-                  msg_out( "   Using pre-calculated pointing corrections of ({0:5.1f},{1:5.1f}) arc-seconds".format(dx,dy) )
+#  Report any pointing corrections that will be used, and create the new
+#  map. The call signature for makemap depends on whether an external mask
+#  is being supplied or not.
+            if dx is not None and dy is not None:
+               msg_out( "   Using pre-calculated pointing corrections of ({0:5.1f},{1:5.1f}) arc-seconds".format(dx,dy) )
 
-               qui_maps[key] = NDG(mapname, False)
+            qui_maps[key] = NDG(mapname, False)
 
 #  If we will be smoothing the map to the 850 um resolution, we need to
 #  put the original (unsmoothed) map in a different NDG object. The final
 #  (smoothed) map will be put into the MAPDIR directory.
-               if smooth450:
-                  unsmoothed = NDG( 1 )
-               else:
-                  unsmoothed = qui_maps[key]
+            if smooth450:
+               unsmoothed = NDG( 1 )
+            else:
+               unsmoothed = qui_maps[key]
 
-               try:
+            try:
 
 #  If we are using the default value for PCA.PCATHRESH (as indicated by
 #  pcathresh being zero), we need to look out for makemap not converging.
@@ -3171,104 +3955,146 @@ try:
 #  "pcathresh" is zero, indicating that no value has yet been determined for
 #  PCA.PCATHRESH. We also require the NUMITER config parameter is negative
 #  - i.e. MAPTOL defines convergence.
+               if numiter is None:
                   sel =  "450=1,850=0" if ( filter == 450 ) else "450=0,850=1"
                   numiter = float( invoke("$KAPPA_DIR/configecho name=numiter config=^{0} "
                                           "defaults=$SMURF_DIR/smurf_makemap.def "
                                           "select=\"\'{1}\'\"".format(conf,sel)))
-                  if pcathresh == 0 and numiter < 0:
-                     pcathresh = pcathresh_def1 if automask else pcathresh_def2
-                     abpar = "abortsoon=yes"
-                  else:
-                     abpar = ""
+               if pcathresh == 0 and numiter < 0:
+                  pcathresh = pcathresh_def1 if automask else pcathresh_def2
+                  abpar = "abortsoon=yes"
+               else:
+                  abpar = ""
 
-                  attempt = 0
-                  again = True
-                  while again:
-                     attempt += 1
+               if not maskmap:
+                  mmpars = ("out={0} ref={1} pointing={2} pixsize={3} {4} {5} {6}".
+                            format(unsmoothed,tref,pntfile,pixsize,ip,abpar,initsky))
+               else:
+                  mmpars = ("out={0} ref={1} pointing={2} pixsize={3} {4} {5} {6} {7}".
+                            format(unsmoothed,tref,pntfile,pixsize,ip,pcamaskpar,
+                                   abpar,initsky))
+               mmcmd = ("$SMURF_DIR/makemap in={0} config=\"'^{1}{2}'\" {3}".
+                        format(isdf,conf,pcapars.get(conf,""),mmpars))
+
+#  If we do not need to check convergence, and concurrent processing has
+#  been requested, defer the creation of the map until all maps that
+#  need to be created have been identified.
+               if abpar == "" and nprocs > 1:
+                  pending.append( (key,unsmoothed,dx,dy,mmcmd) )
+                  continue
 
-                     if not maskmap:
-                        invoke("$SMURF_DIR/makemap in={0} config=^{1} out={2} ref={3} pointing={4} "
-                               "pixsize={5} {6} {7} {8}".format(isdf,conf,unsmoothed,tref,pntfile,pixsize,ip,abpar,initsky))
-                     else:
-                        invoke("$SMURF_DIR/makemap in={0} config=^{1} out={2} ref={3} pointing={4} "
-                            "pixsize={5} {6} {7} {8} {9}".format(isdf,conf,unsmoothed,tref,pntfile,
-                                                                 pixsize,ip,pcamaskpar,abpar,initsky))
+               attempt = 0
+               again = True
+               while again:
+                  attempt += 1
+                  invoke( mmcmd )
 
 #  If we do not yet know what pcathresh value to use, see if makemap aborted
 #  due to slow convergence. If so, reduce the number of PCA components
 #  removed on each iteration by 25% and re-run makemap.
-                     if abpar != "":
-                        abortedat = int( float( get_task_par( "abortedat", "makemap" ) ) )
-                        if abortedat == 0:
+                  if abpar != "":
+                     abortedat = int( float( get_task_par( "abortedat", "makemap" ) ) )
+                     if abortedat == 0:
+                        again = False
+                        if attempt > 1:
+                           msg_out( "MAKEMAP converged succesfully, so all further "
+                                    "maps will be created using PCA.PCATHRESH={0}.".
+                                    format( pcathresh ) )
+
+                     elif attempt < 20:
+                        reduction = int( -pcathresh * 0.25 )
+                        if reduction < 2:
+                           reduction = 2
+                        pcathresh_old = pcathresh
+                        pcathresh = -( -pcathresh - reduction )
+                        if pcathresh > -5:
+                           pcathresh = -5
+
+                        if pcathresh <= pcathresh_old:
                            again = False
-                           if attempt > 1:
-                              msg_out( "MAKEMAP converged succesfully, so all further "
-                                       "maps will be created using PCA.PCATHRESH={0}.".
-                                       format( pcathresh ) )
-
-                        elif attempt < 20:
-                           reduction = int( -pcathresh * 0.25 )
-                           if reduction < 2:
-                              reduction = 2
-                           pcathresh_old = pcathresh
-                           pcathresh = -( -pcathresh - reduction )
-                           if pcathresh > -5:
-                              pcathresh = -5
-
-                           if pcathresh <= pcathresh_old:
-                              again = False
-                              msg_out("MAKEMAP failed to converge but we have "
-                                      "reached the lower limit for PCA.PCATHRESH, so "
-                                      "all further maps will be created using "
-                                      "PCA.PCATHRESH={0}.".format( pcathresh ) )
-                           else:
-                              msg_out("MAKEMAP failed to converge - trying "
-                                      "the current observation again with "
-                                      "PCA.PCATHRESH set to {0} (it was {1}).".
-                                      format(pcathresh,pcathresh_old))
-                              fd = open( conf, "a" )
-                              fd.write( "pca.pcathresh = {0}\n".format( pcathresh ) )
-                              fd.close()
+                           msg_out("MAKEMAP failed to converge but we have "
+                                   "reached the lower limit for PCA.PCATHRESH, so "
+                                   "all further maps will be created using "
+                                   "PCA.PCATHRESH={0}.".format( pcathresh ) )
                         else:
-                           again = False
-                           msg_out( "MAKEMAP failed to converge again - "
-                                    "giving up and using PCA.PCATHRESH={0}.".
-                                    format( pcathresh ) )
+                           msg_out("MAKEMAP failed to converge - trying "
+                                   "the current observation again with "
+                                   "PCA.PCATHRESH set to {0} (it was {1}).".
+                                   format(pcathresh,pcathresh_old))
+                           pcapars[conf] = ",pca.pcathresh={0}".format( pcathresh )
+                           mmcmd = ("$SMURF_DIR/makemap in={0} config=\"'^{1}{2}'\" {3}".
+                                    format(isdf,conf,pcapars[conf],mmpars))
+                     else:
+                        again = False
+                        msg_out( "MAKEMAP failed to converge again - "
+                                 "giving up and using PCA.PCATHRESH={0}.".
+                                 format( pcathresh ) )
 
 #  If we already knew the value to use for PCA.PCATHRESH, just proceeed without
 #  checking convergence.
-                     else:
-                        again = False
+                  else:
+                     again = False
 
-#  If required smooth the output map to the resolution of the 850 um beam.
-                  if smooth450:
-                     Smooth450( unsmoothed, qui_maps[key] )
-
-#  Store FITS headers holding the pointing corrections that were actually used.
-                  if dx is not None:
-                     sym = invoke("$KAPPA_DIR/wcsattrib ndf={0} mode=get name='Symbol(1)'".
-                                        format(qui_maps[key]))
-                     invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=POINT_DX "
-                            "edit=a value={1} comment=\"'Used {2} pointing correction [arcsec]'\""
-                            " position=! mode=interface".format(qui_maps[key],dx,sym))
-
-                  if dy is not None:
-                     sym = invoke("$KAPPA_DIR/wcsattrib ndf={0} mode=get name='Symbol(2)'".
-                                  format(qui_maps[key]))
-                     invoke("$KAPPA_DIR/fitsmod ndf={0} keyword=POINT_DY "
-                            "edit=a value={1} comment=\"'Used {2} pointing correction [arcsec]'\""
-                            " position=! mode=interface".format(qui_maps[key],dy,sym))
+#  Smooth the map if required and store the pointing corrections.
+               FinishMap( unsmoothed, qui_maps[key], dx, dy, smooth450 )
 
 #  If we are processing I data with makemap (i.e. "step 1"), and no ref
 #  map was given, then use the I map just created as the ref map for the
 #  remaining observations. This ensures that all the auto-masked I maps
 #  are aligned with each other.
-                  if ref == "!" and qui == 'I':
-                     ref = qui_maps[key]
+               if ref == "!" and qui == 'I':
+                  ref = qui_maps[key]
 
 #  If makemap failed, warn the user and delete any map that was created,
 #  and pass on to the next observation chunk.
+            except starutil.AtaskError:
+               msg_out("WARNING: makemap failed - could not produce a {1} map "
+                       "for observation chunk {0}".format(key,qui) )
+               try:
+                  invoke("$KAPPA_DIR/erase object={0} ok=yes".format(qui_maps[key]))
                except starutil.AtaskError:
+                  pass
+               del qui_maps[key]
+               if abpar != "":
+                  pcathresh = 0
+               continue
+
+#  A map was obtained successfully. Add it to the list of maps in mapdir.
+            new_maps.append( qui_maps[key] )
+
+#  Now create any maps that were deferred above, running up to "nprocs"
+#  makemap processes at any one time. Each makemap process uses its own
+#  ADAM_USER directory. The maps are started in order of decreasing size
+#  of input data, so that the longest observations do not end up being
+#  processed on their own at the end.
+         if pending:
+            msg_out("\nMaking {0} {1} maps using up to {2} concurrent "
+                    "makemap processes...\n".format(len(pending),qui,nprocs) )
+            sizes = [ DataSize( qui_list[ job[0] ] ) for job in pending ]
+            order = sorted( range( len( pending ) ), key=lambda i: -sizes[i] )
+            with concurrent.futures.ThreadPoolExecutor( max_workers=nprocs ) as pool:
+               futures = {}
+               for i in order:
+                  futures[ i ] = pool.submit( RunTask, pending[i][4],
+                                              NDG.subdir() )
+
+#  Complete each map in the main thread, in the original order. Each map
+#  is completed as soon as it and all earlier maps have been created, so
+#  that this overlaps with the creation of later maps. The main thread
+#  uses the default ADAM_USER directory and so does not interfere with
+#  the makemap processes.
+               for i in range( len( pending ) ):
+                  (key,unsmoothed,dx,dy,mmcmd) = pending[ i ]
+                  if futures[ i ].result():
+                     try:
+                        FinishMap( unsmoothed, qui_maps[key], dx, dy, smooth450 )
+                        if ref == "!" and qui == 'I':
+                           ref = qui_maps[key]
+                        new_maps.append( qui_maps[key] )
+                        continue
+                     except starutil.AtaskError:
+                        pass
+
                   msg_out("WARNING: makemap failed - could not produce a {1} map "
                           "for observation chunk {0}".format(key,qui) )
                   try:
@@ -3276,12 +4102,6 @@ try:
                   except starutil.AtaskError:
                      pass
                   del qui_maps[key]
-                  if abpar != "":
-                     pcathresh = 0
-                  continue
-
-#  A map was obtained successfully. Add it to the list of maps in mapdir.
-            new_maps.append( qui_maps[key] )
 
 
 
@@ -3326,21 +4146,27 @@ try:
             elif len(qui_maps) > 1:
                MakeCoadd( qui, qui_maps, imaps, coadd, filter, mapvar, automask, obsweight )
 
-               try:
-                  invoke("$KAPPA_DIR/erase object={0}.more.smurf.exp_time ok=yes".format(coadd))
-                  invoke("$KAPPA_DIR/wcsmosaic in={{{0}}}.more.smurf.exp_time lbnd=! ref=! "
-                         "out={1}.more.smurf.exp_time conserve=no method=bilin norm=no "
-                         "variance=no".format(allmaps,coadd))
-               except starutil.AtaskError:
-                  msg_out( "No exposure time array will be present in {0}".format(coadd))
-
-               try:
-                  invoke("$KAPPA_DIR/erase object={0}.more.smurf.weights ok=yes".format(coadd))
-                  invoke("$KAPPA_DIR/wcsmosaic in={{{0}}}.more.smurf.weights lbnd=! ref=! "
-                         "out={1}.more.smurf.weights conserve=no method=bilin norm=no "
-                         "variance=no".format(allmaps,coadd))
-               except starutil.AtaskError:
-                  msg_out( "No weights array will be present in {0}".format(coadd))
+#  The two extension NDFs are independent, so coadd them concurrently.
+#  Each is coadded into a temporary NDF, since concurrent processes cannot
+#  safely write to the same container file. They are then copied into the
+#  coadd one at a time.
+               extnames = { "exp_time": "exposure time", "weights": "weights" }
+               extmaps = { comp: NDG( 1 ) for comp in extnames }
+               cmds = [ "$KAPPA_DIR/wcsmosaic in={{{0}}}.more.smurf.{1} lbnd=! ref=! "
+                        "out={2} conserve=no method=bilin norm=no variance=no".
+                        format(allmaps,comp,extmaps[comp]) for comp in extnames ]
+               oks = InvokeConcurrently( cmds, min( nprocs, len( cmds ) ) )
+
+               for ( comp, ok ) in zip( extnames, oks ):
+                  try:
+                     invoke("$KAPPA_DIR/erase object={0}.more.smurf.{1} ok=yes".format(coadd,comp))
+                     if ok:
+                        invoke("$KAPPA_DIR/ndfcopy in={0} out={1}.more.smurf.{2}".
+                               format(extmaps[comp],coadd,comp))
+                        continue
+                  except starutil.AtaskError:
+                     pass
+                  msg_out( "No {0} array will be present in {1}".format(extnames[comp],coadd))
 
 
 #  Now deal with cases where a coadd has already been created by skyloop.
@@ -3356,12 +4182,13 @@ try:
                                   "MAPVAR=YES since only {1} {0} maps are available".
                                   format(qui, len(allmaps), "map" if (len(allmaps)==1) else "maps" ) )
 
-            junk = NDG( 1 )
-            invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
-                   "conserve=no method=near variance=yes genvar=yes".
-                   format(allmaps,junk))
-            invoke("$KAPPA_DIR/setvar ndf={0} from={1} comp=Variance".
-                   format(coadd,junk))
+            if not MapVariance( allmaps, coadd ):
+               junk = NDG( 1 )
+               invoke("$KAPPA_DIR/wcsmosaic in={0} lbnd=! ref=! out={1} "
+                      "conserve=no method=near variance=yes genvar=yes".
+                      format(allmaps,junk))
+               invoke("$KAPPA_DIR/setvar ndf={0} from={1} comp=Variance".
+                      format(coadd,junk))
 
 #  If required, trim off the edges of the coadds that have an exposure
 #  time less than "trim" times the mean exposure time.
@@ -3504,18 +4331,26 @@ try:
             imap_cat = tmp
 
 #  Ensure the Q, U and I images all have the same bounds, equal to the
-#  overlap region between them. To get the overlap region, use MATHS to
-#  add them together. Then use ndfcopy to produce the sections from each,
+#  overlap region between them. The overlap region is the intersection of
+#  their pixel bounds. Use ndfcopy to produce the sections from each,
 #  which match the overlap area.
-         tmp = NDG( 1 )
-         invoke( "$KAPPA_DIR/maths exp=\"'ia+ib+ic'\" ia={0} ib={1} ic={2} out={3}".
-                 format(qmap_cat,umap_cat,imap_cat,tmp) )
+         bounds = [ PixelBounds( ndf ) for ndf in (qmap_cat,umap_cat,imap_cat) ]
+         lbnd = [ max( lbs ) for lbs in zip( *[ b[0] for b in bounds ] ) ]
+         ubnd = [ min( ubs ) for ubs in zip( *[ b[1] for b in bounds ] ) ]
+         if any( lb > ub for (lb,ub) in zip( lbnd, ubnd ) ):
+            raise starutil.InvalidParameterError("The Q, U and I maps do not "
+                                                 "overlap.")
+         section = ",".join( "{0}:{1}".format(lb,ub) for (lb,ub) in zip( lbnd, ubnd ) )
+
          qtrim = NDG( 1 )
-         invoke( "$KAPPA_DIR/ndfcopy in={0} like={1} out={2}".format(qmap_cat,tmp,qtrim) )
+         invoke( "$KAPPA_DIR/ndfcopy in={0} out={1}".
+                 format(starutil.shell_quote("{0}({1})".format(NdfPath(qmap_cat),section)),qtrim) )
          utrim = NDG( 1 )
-         invoke( "$KAPPA_DIR/ndfcopy in={0} like={1} out={2}".format(umap_cat,tmp,utrim) )
+         invoke( "$KAPPA_DIR/ndfcopy in={0} out={1}".
+                 format(starutil.shell_quote("{0}({1})".format(NdfPath(umap_cat),section)),utrim) )
          itrim = NDG( 1 )
-         invoke( "$KAPPA_DIR/ndfcopy in={0} like={1} out={2}".format(imap_cat,tmp,itrim) )
+         invoke( "$KAPPA_DIR/ndfcopy in={0} out={1}".
+                 format(starutil.shell_quote("{0}({1})".format(NdfPath(imap_cat),section)),itrim) )
 
 #  The polarisation vectors are calculated by the polpack:polvec command,
 #  which requires the input Stokes vectors in the form of a 3D cube. Paste
@@ -19,6 +19,11 @@
 *     By default, the Q, U, I and PI catalogue values, together with the
 *     maps specified by parameters "QUI" and "PI", are in units of
 *     Jy/beam (see parameter Jy).
+*
+*     If the STAR_TEMP environment variable is not set, the temporary
+*     files are placed within "/dev/shm" when it is available, so that
+*     they are held in memory rather than on disk. This can be prevented
+*     by setting the POL2STACK_NO_TMPFS environment variable.
 
 *  Usage:
 *     pol2stack inq inu ini cat pi [retain] [qui] [in] [msg_filter] [ilevel] [glevel]
@@ -168,6 +173,10 @@
 '''
 
 
+import concurrent.futures
+import os
+import tempfile
+import threading
 import starutil
 from starutil import invoke
 from starutil import AtaskError
@@ -191,6 +200,88 @@ def cleanup():
    else:
       NDG.cleanup()
 
+#  A function to place the directory holding temporary NDFs within the
+#  in-memory "/dev/shm" file system, if it is available. None of the
+#  intermediate NDFs created by this script need to survive it, so there
+#  is no need to write them to disk. This is not done if the user has
+#  indicated where temporary files should go using STAR_TEMP, or has set
+#  POL2STACK_NO_TMPFS, or if "/dev/shm" has less than TMPFS_MINFREE bytes
+#  free (a generous margin above the few tens of MB used by a typical set
+#  of POL2 mosaics). Must be called before any NDG is created.
+TMPFS_MINFREE = 1024**3
+def UseTmpfs():
+   if "STAR_TEMP" in os.environ or "POL2STACK_NO_TMPFS" in os.environ:
+      return
+   if not os.path.isdir( "/dev/shm" ) or not os.access( "/dev/shm", os.W_OK ):
+      return
+   try:
+      st = os.statvfs( "/dev/shm" )
+      if st.f_bavail*st.f_frsize >= TMPFS_MINFREE:
+         NDG.tempdir = tempfile.mkdtemp( prefix='NDG_', dir="/dev/shm" )
+   except OSError:
+      pass
+
+#  The smallest number of Q/U pairs worth rotating in a separate polrotref
+#  process, and the largest number of polrotref processes to run at the
+#  same time.
+POLROT_MINBLOCK = 8
+POLROT_MAXPROC = 8
+
+#  A function to write a list of NDF paths to a new text file in the
+#  temporary directory. Returns a shell quoted group expression ("^file")
+#  that refers to the file. This avoids the ndfecho invocation made when
+#  creating an NDG.
+def GroupFile( ndfs ):
+   path = NDG.tempfile()
+   with open( path, "w" ) as fd:
+      for ndf in ndfs:
+         fd.write( "{0}\n".format( ndf ) )
+   return starutil.shell_quote( "^{0}".format( path ) )
+
+#  A function to read the WCS FrameSet of an NDF in-process, using the
+#  starlink.ndfpack module. Returns a tuple holding a list of the Domains
+#  of all Frames, and the Domain of the current Frame. None is returned if
+#  the module is not available or the WCS cannot be read.
+def FrameDomains( ndf ):
+   try:
+      from starlink.ndfpack import Ndf
+      wcs = Ndf( ndf[0] ).wcs
+      domains = [ wcs.getframe( iframe ).Domain for iframe in range( 1, wcs.Nframe + 1 ) ]
+      return ( domains, domains[ wcs.Current - 1 ] )
+   except Exception:
+      return None
+
+#  A function to run several independent sequences of commands
+#  concurrently, one thread per sequence. The commands within each sequence
+#  are run in order. Each sequence uses its own ADAM_USER directory so that
+#  concurrent commands do not interfere with each others parameter files,
+#  and the output is buffered so that the screen output from different
+#  commands is not interleaved. Any error is re-raised in the calling
+#  thread once all sequences have ended. If an error occurs, or control-C
+#  is pressed, no further commands are started in the other sequences, so
+#  that we do not have to wait for them to run to completion before
+#  cleaning up.
+def RunConcurrently( jobs ):
+   abort = threading.Event()
+   def RunSequence( cmds, adamdir ):
+      try:
+         for cmd in cmds:
+            if abort.is_set():
+               break
+            invoke( cmd, buffer=True, env={ "ADAM_USER": adamdir } )
+      except:
+         abort.set()
+         raise
+
+   with concurrent.futures.ThreadPoolExecutor( max_workers=len( jobs ) ) as pool:
+      futures = [ pool.submit( RunSequence, cmds, NDG.subdir() ) for cmds in jobs ]
+      try:
+         for future in futures:
+            future.result()
+      except:
+         abort.set()
+         raise
+
 
 #  Catch any exception so that we can always clean up, even if control-C
 #  is pressed.
@@ -232,6 +323,9 @@ try:
    params.append(starutil.Par0L("Jy", "Should units be converted from pW to Jy/beam?",
                  True, noprompt=True))
 
+#  Put temporary files in memory if possible.
+   UseTmpfs()
+
 #  Initialise the parameters to hold any values supplied on the command
 #  line.
    parsys = ParSys( params )
@@ -244,11 +338,18 @@ try:
 #  stare & spin data) is being supplied.
    inqui = parsys["IN"].value
 
-#  If supplied, get groups containing all the Q, U and I images.
+#  If supplied, get groups containing all the Q, U and I images. The
+#  group already holds the full path to each NDF within the container
+#  files, so sort them into Q, U and I groups in a single pass, rather
+#  than running ndfecho for each Stokes parameter.
    if inqui:
-      qin = inqui.filter("'\.Q$'" )
-      uin = inqui.filter("'\.U$'" )
-      iin = inqui.filter("'\.I$'" )
+      stokes = { "Q": [], "U": [], "I": [] }
+      for ndf in inqui:
+         comp = ndf[ -1: ]
+         if ndf[ -2: -1 ] == "." and comp in stokes:
+            stokes[ comp ].append( ndf )
+      (qin,uin,iin) = [ NDG( stokes[ comp ] ) if stokes[ comp ] else None
+                        for comp in ( "Q", "U", "I" ) ]
 
 #  If not supplied, try again using INQ, INU and INI (i.e. scan & spin
 #  data).
@@ -344,28 +445,58 @@ try:
    itrim = NDG(iin)
    invoke( "$KAPPA_DIR/ndfcopy in={0} out={1} trim=yes".format(iin,itrim) )
 
-#  Rotate them to use the same polarimetric reference direction.
+#  Rotate them to use the same polarimetric reference direction. Each
+#  Q/U pair is rotated independently of the others, so if there are many
+#  pairs, divide them into contiguous blocks of at least POLROT_MINBLOCK
+#  pairs and rotate the blocks concurrently (using no more than the number
+#  of CPUs, or POLROT_MAXPROC, processes). All blocks use the first Q image
+#  as the reference, so the reference direction is the same for all
+#  blocks. The input and output NDFs for each block are listed in text
+#  files.
    qrot = NDG(qtrim)
    urot = NDG(utrim)
-   invoke( "$POLPACK_DIR/polrotref qin={0} uin={1} like={2} qout={3} uout={4} ".
-           format(qtrim,utrim,qtrim[0],qrot,urot) )
+   rotate = "$POLPACK_DIR/polrotref qin={0} uin={1} like={2} qout={3} uout={4} "
+   npair = len( qtrim )
+   nblock = min( os.cpu_count() or 1, POLROT_MAXPROC, npair // POLROT_MINBLOCK )
+   if nblock > 1:
+      groups = [ list( ndg ) for ndg in ( qtrim, utrim, qrot, urot ) ]
+      jobs = []
+      for iblock in range( nblock ):
+         lo = ( iblock*npair )//nblock
+         hi = ( ( iblock + 1 )*npair )//nblock
+         ( qblock, ublock, qrblock, urblock ) = [ GroupFile( group[ lo:hi ] )
+                                                  for group in groups ]
+         jobs.append( [ rotate.format( qblock, ublock, qtrim[0], qrblock,
+                                       urblock ) ] )
+      RunConcurrently( jobs )
+   else:
+      invoke( rotate.format(qtrim,utrim,qtrim[0],qrot,urot) )
 
 #  Mosaic them into a single set of Q, U and I images, aligning them
-#  with the first I image.
+#  with the first I image. The mosaiced images will not contain a POLANAL
+#  Frame (assuming the I maps have no POLANAL Frame). So copy the POLANAL
+#  Frame from the original Q and U maps to the mosaics. The processing of
+#  each Stokes parameter is independent of the others, so the three
+#  sequences of commands are run concurrently.
    qmos = NDG( 1 )
-   invoke( "$KAPPA_DIR/wcsmosaic in={0} out={1} ref={2} method=bilin accept".format(qrot,qmos,itrim[0]) )
    umos = NDG( 1 )
-   invoke( "$KAPPA_DIR/wcsmosaic in={0} out={1} ref={2} method=bilin accept".format(urot,umos,itrim[0]) )
    imos = NDG( 1 )
-   invoke( "$KAPPA_DIR/wcsmosaic in={0} out={1} ref={2} method=bilin accept".format(itrim,imos,itrim[0]) )
+   mosaic = "$KAPPA_DIR/wcsmosaic in={0} out={1} ref={2} method=bilin accept"
+   wcsadd = ( "$KAPPA_DIR/wcsadd ndf={0} refndf={1} maptype=refndf "
+              "frame=grid domain=polanal retain=yes" )
+
+#  If there is only one I image, it is also the reference image, so the
+#  I "mosaic" would just be a resampling of the image onto its own pixel
+#  grid. Copy it instead. This cannot be done for single Q or U images
+#  since they still need to be aligned with the I image.
+   if len( itrim ) == 1:
+      imosaic = "$KAPPA_DIR/ndfcopy in={0} out={1}".format(itrim[0],imos)
+   else:
+      imosaic = mosaic.format(itrim,imos,itrim[0])
 
-#  The mosaiced images will not contain a POLANAL Frame (assuming the I
-#  maps have no POLANAL Frame). So copy the POLANAL Frame from the
-#  original Q and U maps to the mosaics.
-   invoke( "$KAPPA_DIR/wcsadd ndf={0} refndf={1} maptype=refndf "
-           "frame=grid domain=polanal retain=yes".format(qmos,qrot[0]) )
-   invoke( "$KAPPA_DIR/wcsadd ndf={0} refndf={1} maptype=refndf "
-           "frame=grid domain=polanal retain=yes".format(umos,urot[0]) )
+   RunConcurrently( [ [ mosaic.format(qrot,qmos,itrim[0]), wcsadd.format(qmos,qrot[0]) ],
+                      [ mosaic.format(urot,umos,itrim[0]), wcsadd.format(umos,urot[0]) ],
+                      [ imosaic ] ] )
 
 #  The three mosaics will now be aligned in pixel coords, but they could
 #  still have different pixel bounds. We trim them to a common area by
@@ -374,34 +505,28 @@ try:
    sum = NDG( 1 )
    invoke( "$KAPPA_DIR/maths exp=\"'ia+ib+ic'\" ia={0} ib={1} ic={2} "
            "out={3}".format(qmos,umos,imos,sum) )
-   invoke( "$KAPPA_DIR/setbound ndf={0} like={1}".format(qmos,sum) )
-   invoke( "$KAPPA_DIR/setbound ndf={0} like={1}".format(umos,sum) )
-   invoke( "$KAPPA_DIR/setbound ndf={0} like={1}".format(imos,sum) )
+   jobs = [ [ "$KAPPA_DIR/setbound ndf={0} like={1}".format(mos,sum) ]
+            for mos in (qmos,umos,imos) ]
 
 #  If output PI and I values are in Jy, convert the Q, U and I maps to Jy.
+#  These steps are added to the end of the command sequence for each
+#  Stokes parameter, and the three sequences are then run concurrently.
    if jy:
-      temp = NDG(1)
-      invoke( "$KAPPA_DIR/cmult in={0} scalar={1} out={2}".format(qmos,fcf_qu,temp ))
-      invoke( "$KAPPA_DIR/setunits ndf={0} units=Jy/beam".format(temp ))
-      qmos = temp
-
-      temp = NDG(1)
-      invoke( "$KAPPA_DIR/cmult in={0} scalar={1} out={2}".format(umos,fcf_qu,temp ))
-      invoke( "$KAPPA_DIR/setunits ndf={0} units=Jy/beam".format(temp ))
-      umos = temp
-
-      temp = NDG(1)
-      invoke( "$KAPPA_DIR/cmult in={0} scalar={1} out={2}".format(imos,fcf_i,temp ))
-      invoke( "$KAPPA_DIR/setunits ndf={0} units=Jy/beam".format(temp ))
-      imos = temp
+      temps = ( NDG(1), NDG(1), NDG(1) )
+      for (cmds,mos,fcf,temp) in zip( jobs, (qmos,umos,imos), (fcf_qu,fcf_qu,fcf_i), temps ):
+         cmds.append( "$KAPPA_DIR/cmult in={0} scalar={1} out={2}".format(mos,fcf,temp ))
+         cmds.append( "$KAPPA_DIR/setunits ndf={0} units=Jy/beam".format(temp ))
+      (qmos,umos,imos) = temps
 
 #  If output PI values are in pW, scale the I map to take account of the
 #  difference in FCF with and without POL2 in the beam.
    else:
       temp = NDG(1)
-      invoke( "$KAPPA_DIR/cmult in={0} scalar={1} out={2}".format( imos, fcf_i/fcf_qu, temp ))
+      jobs[ 2 ].append( "$KAPPA_DIR/cmult in={0} scalar={1} out={2}".format( imos, fcf_i/fcf_qu, temp ))
       imos = temp
 
+   RunConcurrently( jobs )
+
 #  If required, save the Q, U and I images.
    if qui is not None:
       invoke( "$KAPPA_DIR/ndfcopy in={0} out={1}.Q".format(qmos,qui) )
@@ -410,28 +535,48 @@ try:
 
 #  The polarisation vectors are calculated by the polpack:polvec command,
 #  which requires the input Stokes vectors in the form of a 3D cube. Paste
-#  the 2-dimensional Q, U and I images into a 3D cube.
-   planes = NDG( [qmos,umos,imos] )
+#  the 2-dimensional Q, U and I images into a 3D cube. The three images
+#  are given to paste as a comma-separated list, rather than creating
+#  another NDG (and group file) to hold them.
+   planes = starutil.shell_quote( "{0},{1},{2}".format(qmos[0],umos[0],imos[0]) )
    cube = NDG( 1 )
    invoke( "$KAPPA_DIR/paste in={0} shift=\[0,0,1\] out={1}".format(planes,cube))
 
-#  Check that the cube has a POLANAL frame, as required by POLPACK. First
-#  note the Domain of the original current Frame
-   domain = invoke( "$KAPPA_DIR/wcsattrib ndf={0} mode=get name=Domain".format(cube) )
-   try:
-      invoke( "$KAPPA_DIR/wcsframe ndf={0} frame=POLANAL".format(cube) )
-
-#  If it does not, see if it has a "POLANAL-" Frame (kappa:paste can
-#  cause this by appending "-" to the end of the domain name to account for
-#  the extra added 3rd axis).
-   except AtaskError:
-      invoke( "$KAPPA_DIR/wcsframe ndf={0} frame=POLANAL-".format(cube) )
+#  Check that the cube has a POLANAL frame, as required by POLPACK. If the
+#  Frame domains can be read in-process and there is a POLANAL Frame,
+#  nothing needs to be done.
+   frames = FrameDomains( cube )
+   if frames is None or "POLANAL" not in frames[ 0 ]:
 
-#  We only arrive here if the POLANAL- frame was found, so rename it to POLANAL
-      invoke( "$KAPPA_DIR/wcsattrib ndf={0} mode=set name=domain newval=POLANAL".format(cube) )
-
-#  Re-instate the original current Frame
-   invoke( "$KAPPA_DIR/wcsframe ndf={0} frame={1}".format(cube,domain) )
+#  Note the Domain of the original current Frame.
+      if frames is not None:
+         domain = frames[ 1 ]
+      else:
+         domain = invoke( "$KAPPA_DIR/wcsattrib ndf={0} mode=get name=Domain".format(cube) )
+
+#  If the Frame domains are not known, see if there is a POLANAL Frame by
+#  trying to make it the current Frame.
+      polanal = frames is None
+      if polanal:
+         try:
+            invoke( "$KAPPA_DIR/wcsframe ndf={0} frame=POLANAL".format(cube) )
+         except AtaskError:
+            polanal = False
+
+#  If it does not, use the "POLANAL-" Frame (kappa:paste can cause this by
+#  appending "-" to the end of the domain name to account for the extra
+#  added 3rd axis), and rename it to POLANAL.
+      if not polanal:
+         invoke( "$KAPPA_DIR/wcsframe ndf={0} frame=POLANAL-".format(cube) )
+         invoke( "$KAPPA_DIR/wcsattrib ndf={0} mode=set name=domain newval=POLANAL".format(cube) )
+
+#  Re-instate the original current Frame. This is needed even though the
+#  cube is a temporary file, since polvec uses the current Frame of the
+#  cube to define the coordinates stored in the catalogue. It is not needed
+#  if the original current Frame was the POLANAL (or renamed POLANAL-)
+#  Frame, since that Frame is current again now.
+      if domain.strip().upper() not in ( "POLANAL", "POLANAL-" ):
+         invoke( "$KAPPA_DIR/wcsframe ndf={0} frame={1}".format(cube,domain) )
 
 #  POLPACK needs to know the order of I, Q and U in the 3D cube. Store
 #  this information in the POLPACK enstension within "cube.sdf".